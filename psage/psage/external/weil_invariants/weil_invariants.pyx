@@ -53,19 +53,21 @@ r"""
 
 #include "sage/ext/stdsage.pxi"
 #include "cysignals/signals.pxi"
-from cysignals.memory cimport sig_malloc, sig_realloc, sig_free
+from cysignals.memory cimport sig_malloc, sig_calloc, sig_realloc, sig_free
 from cysignals.signals cimport sig_error
 
 from sage.modules.free_module import span
 from sage.matrix.constructor import Matrix
 from sage.rings.qqbar import QQbar
 from sage.all import copy, exp, Integer, pi, I, walltime, CyclotomicField, ZZ, QQ, is_prime_power, \
-    kronecker, vector, CC, GF, next_prime, lcm, sqrt, cached_function, MatrixSpace#, sage_malloc, sage_free, ZZ
+    kronecker, vector, CC, GF, next_prime, lcm, sqrt, cached_function, MatrixSpace, is_prime, inverse_mod#, sage_malloc, sage_free, ZZ
 from sage.rings.number_field.number_field import NumberField_cyclotomic
-from cython.parallel import prange
+from cython.parallel import prange, threadid
+cimport openmp
 from sage.matrix.matrix_modn_dense_double cimport Matrix_modn_dense_double
 from sage.matrix.matrix_modn_dense_float cimport Matrix_modn_dense_float
 import numpy as np
+from psage.modform.weilrep_tools.local_cache import local_invariants_cache
 
 
 cdef long _el_index(long * c, long *ed, int r) nogil:
@@ -90,13 +92,12 @@ cdef long _el_index(long * c, long *ed, int r) nogil:
         md=md*m
     return ii
 
-cdef long* _elt(long ii, long *ed, int r) nogil:
+cdef void _elt(long ii, long *ed, int r, long *eltl) nogil:
     r"""
-    Returns the element corresponding to the canonical index `ii`
-    in a finite abelian group with elementary divisors specified by `ed`.
+    Writes the coordinates of the element corresponding to the canonical index `ii`
+    in a finite abelian group with elementary divisors specified by `ed`
+    to the buffer `eltl`, which has to provide space for `r` entries.
     """
-    cdef long* eltl = NULL
-    eltl = <long*> sig_malloc(sizeof(long)*r)
     cdef long md = 1
     cdef long jj = 0
     cdef long c = 0
@@ -106,18 +107,114 @@ cdef long* _elt(long ii, long *ed, int r) nogil:
         eltl[jj] = c
         ii = ii - c
         ii = ii/md
-    return eltl
 
 cdef long _neg_index(long ii, long *ed, int r) nogil:
     r"""
-    Returns the negative of the element corresponding to the canonical index `ii`
+    Returns the index of the negative of the element corresponding to the canonical index `ii`
     in a finite abelian group with elementary divisors specified by `ed`.
     """
-    cdef long jj=0
-    cdef long* eltl = _elt(ii, ed, r)
+    cdef long jj = 0
+    cdef long c = 0
+    cdef long md = 1
+    cdef long res = 0
     for jj in xrange(0,r):
-        eltl[jj]=-eltl[jj]
-    return _el_index(eltl, ed, r)
+        c = ii%ed[jj]
+        ii = ii/ed[jj]
+        res = res + ((ed[jj]-c)%ed[jj])*md
+        md = md*ed[jj]
+    return res
+
+cdef long _pm_representatives(long n, long l, bint all_reps, long **JJ, long *ed, int r,
+                              long *reps, long *norms, long *mult) nogil:
+    r"""
+    Computes representatives of the elements of a finite abelian group
+    with elementary divisors `ed` modulo $\pm 1$, together with their norms
+    `B(x,x)/2 % l` with respect to the Gram matrix JJ and the sizes of their
+    $\pm$-orbits (1 or 2).
+
+    The element with canonical index `i` is a representative if the index
+    of its negative is not smaller than `i`. Elements of order at most 2
+    are only representatives if `all_reps` is True.
+
+    The representatives, norms and orbit sizes are written to `reps`, `norms` and `mult`,
+    which have to provide space for `n` entries. They are sorted by norm,
+    and by index for equal norms. Returns the number of representatives
+    or -1 if memory could not be allocated.
+
+    NOTES::
+        This runs in linear time: no list of already seen elements is needed.
+    """
+    cdef long i, jj, kk, m, md, b
+    cdef long nr = 0
+    cdef long* x = <long*> sig_malloc(sizeof(long)*r)
+    cdef long* cnt = <long*> sig_calloc(l+1, sizeof(long))
+    cdef long* tmp = <long*> sig_malloc(sizeof(long)*3*n)
+    if x is NULL or cnt is NULL or tmp is NULL:
+        sig_free(x)
+        sig_free(cnt)
+        sig_free(tmp)
+        return -1
+    for i in xrange(n):
+        # the coordinates of the element and the index of its negative
+        kk = 0
+        md = 1
+        m = i
+        for jj in xrange(r):
+            x[jj] = m % ed[jj]
+            m = m / ed[jj]
+            kk = kk + ((ed[jj] - x[jj]) % ed[jj])*md
+            md = md*ed[jj]
+        if kk < i or (kk == i and not all_reps):
+            continue
+        b = 0
+        for jj in xrange(r):
+            for m in xrange(r):
+                b = b + x[jj]*x[m]*JJ[jj][m]
+        tmp[3*nr] = i
+        tmp[3*nr+1] = (b/2) % l
+        tmp[3*nr+2] = 1 if kk == i else 2
+        cnt[tmp[3*nr+1]+1] += 1
+        nr = nr + 1
+    # stable counting sort by norm
+    for jj in xrange(l):
+        cnt[jj+1] += cnt[jj]
+    for i in xrange(nr):
+        m = tmp[3*i+1]
+        kk = cnt[m]
+        cnt[m] += 1
+        reps[kk] = tmp[3*i]
+        norms[kk] = m
+        mult[kk] = tmp[3*i+2]
+    sig_free(x)
+    sig_free(cnt)
+    sig_free(tmp)
+    return nr
+
+cdef int _bilinear_table(long n, long ni, long l, long **JJ, long *ed, int r, long *Mli,
+                         long **BB, int num_threads) nogil:
+    r"""
+    Fills the table of bilinear forms `BB[i][j] = -B(x_i, x_{i+j}) % l` for `i < ni` and `j < n-i`,
+    where `x_i` is the element with canonical index `Mli[i]`.
+    The rows are computed in parallel by `num_threads` threads.
+
+    Row `i` has `n-i` entries, so the rows are scheduled dynamically to balance the
+    triangular workload. Each thread uses its own scratch space for the linear form
+    `B(x_i, .)`, so the result does not depend on the number of threads.
+
+    Returns -1 if memory could not be allocated and 0 otherwise.
+    """
+    cdef long i, j
+    cdef long* Bi = NULL
+    cdef long* scratch = <long*> sig_malloc(sizeof(long)*r*num_threads)
+    if scratch is NULL:
+        return -1
+    for i in prange(ni, num_threads=num_threads, schedule='dynamic', chunksize=1):
+        Bi = scratch + threadid()*r
+        Bl(Mli[i], JJ, ed, r, Bi)
+        for j in xrange(n-i):
+            BB[i][j] = (l-BBl(Mli[i+j],Bi,ed,r)) % l
+    sig_free(scratch)
+    return 0
 
 cpdef norm_cmp(x, y):
     if x[1] < y[1]:
@@ -125,68 +222,262 @@ cpdef norm_cmp(x, y):
     else:
         return int(1)
     
-cdef long B(long i, long j, long **JJ, long *ed, int r) nogil:
+cdef long B(long i, long j, long **JJ, long *ed, int r, long *buf) nogil:
     r"""
     Returns the bilinear form of the elements with canonical index `i` and `j`
     with respect to the Gram matrix JJ and elementary divisors `ed`.
+    The buffer `buf` has to provide space for `r` entries.
     """
-    #sig_on()
-    cdef long* ll = _elt(j, ed, r)
-    cdef long* kk = _elt(i, ed, r)
-    cdef long ii, jj = 0
-    cdef long res = 0
-    for ii in xrange(r):
-        for jj in xrange(r):
-            res = res + ll[ii]*kk[jj]*JJ[ii][jj]
-    #sig_off()
-    return res
+    Bl(i, JJ, ed, r, buf)
+    return BBl(j, buf, ed, r)
 
-cdef long* Bl(long i, long **JJ, long *ed, int r) nogil:
-    cdef long* ll = _elt(i, ed, r)
+cdef void Bl(long i, long **JJ, long *ed, int r, long *Bi) nogil:
+    r"""
+    Writes the linear form `B(x, .)` for the element `x` with canonical index `i`
+    with respect to the Gram matrix JJ and elementary divisors `ed`
+    to the buffer `Bi`, which has to provide space for `r` entries.
+    """
     cdef long ii, jj = 0
-    cdef long* kk = NULL
-    kk = <long*> sig_malloc(sizeof(long)*r)
+    cdef long c = 0
     for ii in xrange(r):
-        kk[ii] = 0
-        for jj in xrange(r):
-            kk[ii] = kk[ii] + ll[jj]*JJ[jj][ii]
-    return kk
+        Bi[ii] = 0
+    for jj in xrange(r):
+        c = i%ed[jj]
+        i = i/ed[jj]
+        if c != 0:
+            for ii in xrange(r):
+                Bi[ii] = Bi[ii] + c*JJ[jj][ii]
 
 cdef long BBl(long j, long *Bi, long *ed, int r) nogil:
+    r"""
+    Evaluates the linear form `Bi` (see :func:`Bl`) at the element
+    with canonical index `j`.
+    """
     cdef long ii, res = 0
-    cdef long* ll = _elt(j, ed, r)
+    cdef long c = 0
     for ii in xrange(r):
-        res = res + Bi[ii]*ll[ii]
+        c = j%ed[ii]
+        j = j/ed[ii]
+        res = res + Bi[ii]*c
     return res
 
-cpdef cython_invariants_dim(FQM, use_reduction = True, proof = False, debug=0):
+cpdef local_invariants_dim(FQM):
+    r"""
+    Returns the dimension of the invariants of a p-module FQM
+    (as computed by :func:`cython_invariants_dim`) by a closed formula,
+    or None if no formula is known for FQM.
+
+    A formula is known if FQM consists of a single Jordan constituent
+    of rank at most 2. Let $q = p^k$ be its exponent. Then the dimension is:
+
+    - $q^{\pm 1}$, $p$ odd: $1$ if $k$ is even and $0$ otherwise,
+    - $q^{\pm 2}$ if it is split, that is, $p$ is odd and the sign is
+      $\left(\frac{-1}{p}\right)$, or $p = 2$ and the sign is $+$: $k + 1$,
+    - $q^{\pm 2}$ if it is not split: $1$ if $k$ is even and $0$ otherwise,
+    - $q_t^{\pm 2}$, $p = 2$: $k$ if $t = 0$, $1$ if $t = 4$ and $k$ is odd, and $0$ otherwise,
+    - $q_t^{\pm 1}$, $p = 2$: $0$ (the signature is odd).
+
+    In all these cases, the invariants are spanned by the characteristic functions
+    of the self-dual isotropic subgroups, which are linearly independent.
+
+    EXAMPLES::
+
+        sage: A = FiniteQuadraticModule('5^2')
+        sage: local_invariants_dim(A), cython_invariants(A)[1].dimension()
+        (2, 2)
+        sage: A = FiniteQuadraticModule('8^2')
+        sage: local_invariants_dim(A), cython_invariants(A)[1].dimension()
+        (4, 4)
+        sage: A = FiniteQuadraticModule('4_0^2')
+        sage: local_invariants_dim(A), cython_invariants(A)[1].dimension()
+        (2, 2)
+        sage: local_invariants_dim(FiniteQuadraticModule('3^2.9^1')) is None
+        True
+    """
+    return _local_invariants_dim([c[1] for c in FQM.jordan_decomposition()])
+
+cdef _local_invariants_dim(list J):
+    r"""
+    Returns the dimension given by :func:`local_invariants_dim`
+    for the p-module with the list J of Jordan constituents
+    (p, n, r, e[, o]) or None.
+    """
+    if len(J) != 1:
+        return None
+    c = J[0]
+    p, k, r, d = [Integer(x) for x in c[:4]]
+    o = None if len(c) == 4 else Integer(c[4]) % 8
+    if r == 1:
+        if o is not None:
+            return 0
+        return 1 if k % 2 == 0 else 0
+    if r == 2:
+        if o is None:
+            split = (d == kronecker(-1, p)) if p != 2 else (d == 1)
+            if split:
+                return k + 1
+            return 1 if k % 2 == 0 else 0
+        if o == 0:
+            return k
+        if o == 4:
+            return 1 if k % 2 == 1 else 0
+        return 0
+    return None
+
+cpdef cython_invariants_dim(FQM, use_reduction = True, proof = False, debug=0, num_threads = 0, use_formula = True, block_size = 0):
+    r"""
+    Returns the dimension of the invariants of the Weil representation attached to FQM.
+
+    The dimension is multiplicative over the p-parts of FQM.
+    If `use_formula` is True, a closed formula is used for the p-parts
+    for which one is known (see :func:`local_invariants_dim`).
+    The dimensions of the remaining p-parts are computed by linear algebra
+    and kept in the cache ``local_invariants_cache`` from
+    :mod:`psage.modform.weilrep_tools.local_cache`.
+    If `use_formula` is False, linear algebra is used for all p-parts
+    and the cache is not consulted.
+    If `block_size` is positive, the linear algebra is done in row blocks
+    of this size (see :func:`cython_invariants_blocked`).
+
+    EXAMPLES::
+
+        sage: from psage.modform.weilrep_tools.local_cache import local_invariants_cache
+        sage: local_invariants_cache.clear()
+        sage: cython_invariants_dim(FiniteQuadraticModule('3^3.5^2'))
+        2
+        sage: cython_invariants_dim(FiniteQuadraticModule('3^3.13^2'))
+        2
+        sage: local_invariants_cache.info()
+        CacheInfo(hits=1, misses=1, maxsize=16384, currsize=1)
+    """
     if debug > 0:
         print "Computing invariants dimension of {}".format(FQM)
     if FQM.signature() % 2 != 0:
         return 0
-    dim = 0
-    if not is_prime_power(FQM.level()):
-        for p,n in FQM.level().factor():
-            N = None
-            for j in xrange(1,n+1):
-                J = FQM.jordan_decomposition()
-                C = J.constituent(p**j)[0]
-                if N == None and C.level() != 1:
-                    N = C
-                elif C.level() != 1:
-                    N = N + C
-            if dim == 0:
-                dim = cython_invariants_dim(N, use_reduction, proof, debug)
-            else:
-                dim = dim*cython_invariants_dim(N, use_reduction, proof, debug)
-            if dim == 0:
-                return 0
-    else:
-        Sp = cython_invariants(FQM, use_reduction=use_reduction, proof=proof, debug=debug)[1]
-        dim = dim + Sp.dimension()
+    J = FQM.jordan_decomposition()
+    dim = 1
+    for p,n in FQM.level().factor():
+        d = cython_local_invariants_dim(FQM, p, J, use_reduction, proof, debug, num_threads, use_formula, block_size)
+        if debug > 0: print "p = {0}: {1}".format(p, d)
+        dim = dim*d
+        if dim == 0:
+            return 0
     return dim
 
-cpdef cython_invariants_matrices(FQM, K = QQbar, proof = False, debug=0, return_H = False):
+cpdef cython_local_invariants_dim(FQM, p, J = None, use_reduction = True, proof = False, debug=0, num_threads = 0, use_formula = True, block_size = 0):
+    r"""
+    Returns the dimension of the invariants of the Weil representation
+    attached to the p-part of FQM.
+
+    J is the Jordan decomposition of FQM (it is computed if it is not given).
+    The parameters are as for :func:`cython_invariants_dim`.
+    """
+    if J is None:
+        J = FQM.jordan_decomposition()
+    d = _local_invariants_dim([c[1] for c in J if c[1][0] == p]) if use_formula else None
+    if d is not None:
+        return d
+    key = ('dim', J.genus_symbol(p), use_reduction, proof)
+    d = local_invariants_cache.get(key) if use_formula else None
+    if d is not None:
+        return d
+    if is_prime_power(FQM.level()):
+        N = FQM
+    else:
+        N = None
+        for j in xrange(1, FQM.level().valuation(p)+1):
+            C = J.constituent(p**j)[0]
+            if N == None and C.level() != 1:
+                N = C
+            elif C.level() != 1:
+                N = N + C
+    if N.signature() % 2 != 0:
+        d = 0
+    else:
+        d = cython_invariants(N, use_reduction=use_reduction, proof=proof, debug=debug, num_threads=num_threads, block_size=block_size)[1].dimension()
+    local_invariants_cache[key] = d
+    return d
+
+cdef _fill_table_modq(FQM, K, long l, s, s2, long[:] table, debug = 0):
+    r"""
+    Fills table[p] with the representative in [0, q) of the entry
+    $s (z^p + s_2 z^{-p}) / \sqrt{|FQM|}$ of the Weil representation over the prime field K
+    of characteristic q, where $z$ is a primitive l-th root of unity in K.
+    The choices of $s$, $z$ and $\sqrt{|FQM|}$ are compatible.
+    """
+    cdef long ii
+    cdef long q = K.characteristic()
+    pr = K.primitive_element()
+    # now we choose I, sqrt(|FQM|) compatible with the choice of a primitive element
+    I = pr**((q-1)/4)
+    if not s2 == 1:
+        if FQM.signature() == 2:
+            s = -I
+        else:
+            s = I
+    z = pr**((q-1)/l)
+    A = Integer(FQM.order())
+    #print A
+    if A.is_square():
+        w = K(sqrt(A))
+    else:
+        AA = FQM.order()/FQM.order().squarefree_part()
+        AA = sqrt(AA)
+        AA = K(Integer(AA))
+        P = A.prime_factors()[0]
+        if P > 2:
+            PP = kronecker(-1,P)*P
+            zz = z**(l/P)
+            w = sum([kronecker(PP,ii)*zz**ii for ii in xrange(P)])
+            eps = 1 if PP > 0 else -I
+            w = eps*w
+            w = w*AA
+        else:
+            zz = pr**((q-1)/8)
+            w = (zz+zz**(-1))
+            w = w*AA
+    if debug > 0:
+        print "w = {}".format(w)
+    for ii in xrange(l):
+        zt = z**ii
+        if debug > 0:
+            print "zt = {}**{} = {}".format(z, ii, zt)
+        table[ii] = long(K(s)*K(zt + s2 * zt**-1)/K(w))
+
+cdef void _free_buffers(long* ed, long** JJ, int r, long* Mli, long* Mlj, long* Mlm):
+    r"""
+    Frees the buffers allocated by :func:`cython_invariants_matrices`
+    and :func:`cython_invariants_blocked`
+    (all of them may be NULL, and so may the rows of JJ).
+    """
+    cdef int i
+    if JJ != NULL:
+        for i in range(r):
+            sig_free(JJ[i])
+        sig_free(JJ)
+    sig_free(ed)
+    sig_free(Mli)
+    sig_free(Mlj)
+    sig_free(Mlm)
+
+cpdef cython_invariants_matrices(FQM, K = QQbar, proof = False, debug=0, return_H = False, num_threads = 0):
+    r"""
+    Computes the matrices needed to determine the invariants of the Weil representation
+    of FQM over the field K.
+
+    The table of bilinear forms is computed in parallel using `num_threads` threads
+    (the OpenMP default if `num_threads` is 0).
+
+    TESTS:
+
+    The result does not depend on the number of threads::
+
+        sage: A = FiniteQuadraticModule('3^5')
+        sage: H1 = cython_invariants_matrices(A, GF(13), return_H=True, num_threads=1)[2]
+        sage: H4 = cython_invariants_matrices(A, GF(13), return_H=True, num_threads=4)[2]
+        sage: H1 == H4
+        True
+    """
     cdef long i, j = 0
     cdef int l = long(FQM.level())
     cdef long n = long(FQM.order())
@@ -213,54 +504,22 @@ cpdef cython_invariants_matrices(FQM, K = QQbar, proof = False, debug=0, return_
         if not is_prime_power(l):
             raise NotImplementedError('This function can only be called with p-modules.')
 
-        pr = K.primitive_element()
-        # now we choose I, sqrt(|FQM|) compatible with the choice of a primitive element
-        I = pr**((q-1)/4)
-        if not s2 == 1:
-            if FQM.signature() == 2:
-                s = -I
-            else:
-                s = I
-        z = pr**((q-1)/l)
-        A = Integer(FQM.order())
-        #print A
-        if A.is_square():
-            w = K(sqrt(A))
-        else:
-            AA = FQM.order()/FQM.order().squarefree_part()
-            AA = sqrt(AA)
-            AA = K(Integer(AA))
-            P = A.prime_factors()[0]
-            if P > 2:
-                PP = kronecker(-1,P)*P
-                zz = z**(l/P)
-                w = sum([kronecker(PP,ii)*zz**ii for ii in xrange(P)])
-                eps = 1 if PP > 0 else -I
-                w = eps*w
-                w = w*AA
-            else:
-                zz = pr**((q-1)/8)
-                w = (zz+zz**(-1))
-                w = w*AA
-        if debug > 0:
-            print "w = {}".format(w)
-        for ii in xrange(l):
-            zt = z**ii
-            if debug > 0:
-                print "zt = {}**{} = {}".format(z, ii, zt)
-            table[ii] = long(K(s)*K(zt + s2 * zt**-1)/K(w))
+        _fill_table_modq(FQM, K, l, s, s2, table, debug)
         if proof and q > 0:
             if debug > 0: tt = walltime()
             if debug > 0: print "proof"
-            L = QQbar
-            zl = L.zeta(l)
+            L = _proof_field(l)
+            o = L.gen().multiplicative_order()
+            zl = L.gen()**(o/l)
             if s.parent() != ZZ:
-                z8 = L.zeta(8)
+                z8 = L.gen()**(o/8)
                 sl = z8**(-FQM.signature())
             else:
                 sl = s
             # print sl
             wl = L(FQM.order()).sqrt()
+            if wl.complex_embedding().real().sign() < 0:
+                wl = -wl
             table0 = [sl*(zl**p)/wl for p in range(l)]
             if debug > 0: print table0
             if debug > 0: print "table0: {0}".format(walltime(tt))
@@ -269,7 +528,7 @@ cpdef cython_invariants_matrices(FQM, K = QQbar, proof = False, debug=0, return_
             w = K(FQM.order()).sqrt()
         except:
             raise RuntimeError("K = {0} does not contain a square-root of |FQM| = {1}".format(K,FQM.order()))
-    if debug > 0: print q,w
+    if debug > 0 and q == 0: print q,w
 
     if 0 == q:
         if isinstance(K,NumberField_cyclotomic):
@@ -324,11 +583,14 @@ cpdef cython_invariants_matrices(FQM, K = QQbar, proof = False, debug=0, return_
     cdef long** JJ = NULL
     JJ = <long**> sig_malloc(sizeof(long*) * r)
     if JJ is NULL:
+        sig_free(ed)
         raise MemoryError('Cannot allocate memory.')
     for i in xrange(r):
         JJ[i] = NULL
+    for i in xrange(r):
         JJ[i] = <long*> sig_malloc(sizeof(long)*r)
         if JJ[i] == NULL:
+            _free_buffers(ed, JJ, r, NULL, NULL, NULL)
             raise MemoryError('Cannot allocate memory.')
         for j in xrange(r):
             JJ[i][j] =  long((2*l*J[i,j]))
@@ -337,41 +599,35 @@ cpdef cython_invariants_matrices(FQM, K = QQbar, proof = False, debug=0, return_
 
     cdef list Ml = list()
     cdef long ni = 0
-    cdef long kk = 0
-    cdef int f = 0
-    cdef list skip_list = list()
+    cdef bint all_reps = (s2 == 1)
+    cdef long *Mli = NULL
+    cdef long *Mlj = NULL
+    cdef long *Mlm = NULL
     if debug > 0: t = walltime()
-    
-    for i in xrange(n):
-        #x = cython_elt(i,ed)
-        if debug > 1: print "B=", B(i,i,JJ,ed,r)
-        j = int(B(i,i,JJ,ed,r)/2) % l
-        if debug > 1: print "j=",j
-        kk = _neg_index(i,ed,r)
-        #print i, kk, j
-        f = 1
-        if s2 == 1 or kk != i:
-            if not i in skip_list:
-                skip_list.append(i)
-                skip_list.append(kk)
-                if i != kk:
-                    f = 2
-                #print skip_list
-                Ml.append((i,j,f))
-                if j == 0:
-                    ni = ni + 1
-                    #print 'ni: ', ni
+
+    # representatives of the elements modulo +-1, sorted by norm
+    Mli = <long*> sig_malloc(sizeof(long)*n)
+    Mlj = <long*> sig_malloc(sizeof(long)*n)
+    Mlm = <long*> sig_malloc(sizeof(long)*n)
+    if Mli is NULL or Mlj is NULL or Mlm is NULL:
+        _free_buffers(ed, JJ, r, Mli, Mlj, Mlm)
+        raise MemoryError('Cannot allocate memory.')
+    with nogil:
+        n = _pm_representatives(n, l, all_reps, JJ, ed, r, Mli, Mlj, Mlm)
+    if n < 0:
+        _free_buffers(ed, JJ, r, Mli, Mlj, Mlm)
+        raise MemoryError('Cannot allocate memory.')
+    while ni < n and Mlj[ni] == 0:
+        ni = ni + 1
     if debug > 0: print '%f: +- reps'%(walltime(t)); t = walltime()
     if debug > 0: print 'ni = %d'%(ni)
-    n = len(Ml)
 
-    Ml.sort(norm_cmp)
-    cdef long *Mli = NULL
-    Mli = <long*> sig_malloc(sizeof(long)*n)
     cdef long[:] Mlf = np.ndarray(n, dtype=int)
-    for ii, xx in enumerate(Ml):
-        Mli[ii] = xx[0]
-        Mlf[ii] = xx[2]
+    for ii in xrange(n):
+        Ml.append((Mli[ii], Mlj[ii], Mlm[ii]))
+        Mlf[ii] = Mlm[ii]
+    sig_free(Mlj)
+    sig_free(Mlm)
     
     if debug > 0: print 'n = %d'%(n)
     if debug > 0: print '%f: sorting'%(walltime(t)); t = walltime()
@@ -380,67 +636,77 @@ cpdef cython_invariants_matrices(FQM, K = QQbar, proof = False, debug=0, return_
     #we use that it is symmetric and that we only need
     #it for isotropic elements paired with any other element
     cdef long** BB = NULL
-    cdef long* Bli = NULL
+    cdef long* BBdata = NULL
+    cdef int nt = num_threads if num_threads > 0 else openmp.omp_get_max_threads()
+    cdef int res = 0
 
-    BB = <long**> sig_malloc(sizeof(long*)*n)
-    if BB is NULL:
+    # BB[i] = BBdata + offset of row i, where row i has n-i entries
+    BB = <long**> sig_malloc(sizeof(long*)*(ni+1))
+    BBdata = <long*> sig_malloc(sizeof(long)*(ni*n - (ni*(ni-1))/2 + 1))
+    if BB is NULL or BBdata is NULL:
+        sig_free(BB)
+        sig_free(BBdata)
+        _free_buffers(ed, JJ, r, Mli, NULL, NULL)
+        raise MemoryError('Cannot allocate memory.')
+    for i in xrange(ni):
+        BB[i] = BBdata + (i*n - (i*(i-1))/2)
+    with nogil:
+        res = _bilinear_table(n, ni, l, JJ, ed, r, Mli, BB, nt)
+    if res < 0:
+        sig_free(BB)
+        sig_free(BBdata)
+        _free_buffers(ed, JJ, r, Mli, NULL, NULL)
         raise MemoryError('Cannot allocate memory.')
-    for i in prange(ni, nogil=True):
-        BB[i] = NULL
-        BB[i] = <long*> sig_malloc(sizeof(long)*(n-i))
-        #if BB[i] == NULL:
-        #    raise MemoryError('Cannot allocate memory.')
-        Bli = Bl(Mli[i], JJ, ed, r)
-        #sig_on()
-        #if debug > 1:
-        #    print [Bli[ii] for ii in range(r)]
-        #sig_off()
-        for j in xrange(n-i):
-            #BB[i][j] = B(Ml[i+j][0],Ml[i][0],JJ,ed,r) % l
-            BB[i][j] = (l-BBl(Mli[i+j],Bli,ed,r)) % l
 
-    if not JJ is NULL:
-        for i in range(r):
-            if not JJ[i] is NULL:
-                sig_free(JJ[i])
-        sig_free(JJ)
+    _free_buffers(ed, JJ, r, Mli, NULL, NULL)
      
     if debug > 0:
         print 'bilinear form computations: {0}'.format(walltime(t))
         t = walltime()
 
     if debug > 0: t = walltime()
-    #A = np.ndarray((n,ni), dtype=long)
-    #cdef long[:,:] HH = A
-    cdef H = Matrix(K,n,ni)
+    cdef H = None
     cdef long p = 0
+    cdef long tpl = 0
     cdef tp = 0
-    for j in xrange(ni):
-        #print j, f
-        for i in xrange(j, n):
-            p = BB[j][i-j]
-            if q==0:
+    cdef long[:,:] Hn
+    if q > 0:
+        # fill H with integers in [0, q) without the GIL
+        # and convert it to a matrix over K in one step
+        Hn = np.zeros((n,ni), dtype=long)
+        with nogil:
+            for j in xrange(ni):
+                for i in xrange(j, n):
+                    tpl = table[BB[j][i-j]]
+                    Hn[i,j] = (tpl*Mlf[j]) % q
+                    if i==j:
+                        Hn[j,j] = (Hn[j,j] + 2) % q
+                    elif i<ni:
+                        Hn[j,i] = (tpl*Mlf[i]) % q
+        if return_H:
+            H = _modn_matrix(K, Hn)
+        else:
+            U = _modn_matrix(K, Hn[ni:,:])
+            V = _modn_matrix(K, Hn[:ni,:])
+    else:
+        H = Matrix(K,n,ni)
+        for j in xrange(ni):
+            for i in xrange(j, n):
+                p = BB[j][i-j]
                 tp = table0[p]
-            else:
-                tp = table[p]
-            H[i,j] = tp*Mlf[j]
-            if i==j:
-                H[j,j] += 2
-            elif i<ni and i>j:
-                H[j,i] = tp*Mlf[i]
-            #if debug > 1: print "i={0}, j={1}, H[i,j] = {2}, p = {3}".format(i,j,HH[i,j],p)
+                H[i,j] = tp*Mlf[j]
+                if i==j:
+                    H[j,j] += 2
+                elif i<ni and i>j:
+                    H[j,i] = tp*Mlf[i]
+        U = H.matrix_from_rows(range(ni,n))
+        V = H.matrix_from_rows(range(ni))
     if debug > 0: print '%f: init of H'%(walltime(t)); t = walltime()
-    #if debug > 0: print A
-    #if debug > 1: print A.str()
-    #print H.str()
-    #H = Matrix(A)
-    #H = H.change_ring(K)
-    #if debug > 0: print '%f: conversion to H'%(walltime(t)); t = walltime(t)
     
-    if return_H: return Ml, ni, H
-
-    U = H.matrix_from_rows(range(ni,n))
-    V = H.matrix_from_rows(range(ni))
+    if return_H:
+        sig_free(BBdata)
+        sig_free(BB)
+        return Ml, ni, H
     
     if proof and q > 0:
         t = walltime()
@@ -454,32 +720,287 @@ cpdef cython_invariants_matrices(FQM, K = QQbar, proof = False, debug=0, return_
                     print "i={}, j={}, p={}".format(i, j, p)
                 M[i,j] = table0[p]
                 if Ml[j][2] == 2:
-                    M[i,j] += eps*table0[l-p]
+                    M[i,j] += eps*table0[(l-p) % l]
                 if i<ni and i!=j:
-                   M[j,i] = M[i,j]
+                   M[j,i] = table0[p]
                    if Ml[i][2] == 2:
-                       M[j,i] += eps*p
+                       M[j,i] += eps*table0[(l-p) % l]
         if debug > 1: print table0, M
         R = (Ml, ni, U, V, M)
         if debug > 0: print "Matrix M: {0}".format(walltime(t))
     else:
         R = (Ml, ni, U,V)
 
-    if not BB is NULL:
-        for i in range(ni):
-            if not BB[i] is NULL:
-                sig_free(BB[i])
-        sig_free(BB)
+    sig_free(BBdata)
+    sig_free(BB)
 
     return R
 
+cdef _modn_matrix(K, long[:,:] A):
+    r"""
+    Returns the matrix over the prime field K whose entries are given
+    by the array A with entries in [0, p), where p is the characteristic of K.
+
+    For the dense matrix types used for small primes,
+    the entries are copied directly to the storage of the matrix.
+    """
+    cdef Py_ssize_t i, j
+    cdef Py_ssize_t m = A.shape[0]
+    cdef Py_ssize_t k = A.shape[1]
+    cdef Matrix_modn_dense_double Md
+    cdef Matrix_modn_dense_float Mf
+    M = Matrix(K, m, k)
+    if isinstance(M, Matrix_modn_dense_double):
+        Md = M
+        with nogil:
+            for i in xrange(m):
+                for j in xrange(k):
+                    Md._matrix[i][j] = A[i,j]
+    elif isinstance(M, Matrix_modn_dense_float):
+        Mf = M
+        with nogil:
+            for i in xrange(m):
+                for j in xrange(k):
+                    Mf._matrix[i][j] = A[i,j]
+    else:
+        M = Matrix(K, m, k, [A[i,j] for i in xrange(m) for j in xrange(k)])
+    return M
+
 cpdef reconstruction(x):
     if x in [0,1,-1]:
         return x.lift_centered()
     else:
         return 1/QQ((~x).lift_centered())
 
-cpdef cython_invariants(FQM, use_reduction = True, proof = False, checks = False, debug=0, K = None):
+cdef _proof_field(l):
+    r"""
+    Returns the cyclotomic field used to certify invariants of a module of level l.
+    """
+    o = lcm(8, l)
+    return CyclotomicField(o, embedding=CC(QQbar.zeta(o)))
+
+cpdef cython_invariants_crt(FQM, max_primes = 20, debug = 0, num_threads = 0):
+    r"""
+    Computes the invariants of the Weil representation attached to the p-module FQM
+    modulo several primes $q \equiv 1 \bmod \operatorname{lcm}(8, l)$, where $l$ is the level,
+    and lifts the echelonized basis to the rationals by the chinese remainder theorem
+    and rational reconstruction.
+
+    The lifted basis is certified by one exact computation in the cyclotomic field
+    of conductor $\operatorname{lcm}(8, l)$. Since the dimension of the invariants
+    modulo $q$ is an upper bound for the dimension in characteristic $0$,
+    the result is proven.
+
+    A RuntimeError is raised if the basis could not be certified
+    using `max_primes` primes.
+
+    EXAMPLES::
+
+        sage: A = FiniteQuadraticModule('5^2')
+        sage: Ml, V = cython_invariants_crt(A)
+        sage: V.dimension(), V.base_ring()
+        (2, Rational Field)
+        sage: cython_invariants(FiniteQuadraticModule('3^3'), proof='crt')[1].dimension()
+        1
+    """
+    l = FQM.level()
+    m = lcm(8, l)
+    q = 1
+    mod = 1
+    C = None
+    best = None
+    Ml = None
+    M = None
+    for k in xrange(max_primes):
+        q = q + m
+        while not is_prime(q):
+            q = q + m
+        K = GF(q)
+        I = cython_invariants_matrices(FQM, K, proof = M is None, debug=debug, num_threads=num_threads)
+        if not type(I) in [list, tuple]:
+            return I
+        if M is None:
+            Ml, ni, U, V, M = I
+        else:
+            Ml, ni, U, V = I
+        X = U.right_kernel()
+        B = span([V*x for x in X.basis()], K).basis_matrix()
+        if B.nrows() == 0:
+            # the dimension modulo q bounds the dimension in characteristic 0
+            return Ml[:ni], span([], QQ)
+        key = (B.nrows(), B.pivots())
+        if debug > 0: print "q = {0}: dimension {1}".format(q, B.nrows())
+        if best is not None and key > best:
+            # q is a bad prime
+            continue
+        if best is None or key < best:
+            best = key
+            C = B.lift()
+            mod = q
+        else:
+            D = (B - C.change_ring(K))*inverse_mod(mod, q)
+            C = C + mod*D.lift()
+            mod = mod*q
+        try:
+            Bq = C.rational_reconstruction(mod)
+        except ValueError:
+            continue
+        if debug > 0: tt = walltime()
+        L = M.base_ring()
+        BL = Bq.transpose().change_ring(L)
+        N = M.matrix_from_rows(range(ni))
+        NN = M.matrix_from_rows(range(ni, M.nrows()))
+        certified = N*BL == BL and (NN*BL).is_zero()
+        if debug > 0: print "certification: {0} ({1})".format(certified, walltime(tt))
+        if certified:
+            return Ml[:ni], span(Bq.rows(), QQ)
+    raise RuntimeError("Could not certify the invariants of {0} using {1} primes.".format(FQM, max_primes))
+
+cpdef cython_invariants_blocked(FQM, K = None, long block_size = 4096, debug = 0, num_threads = 0):
+    r"""
+    Computes the invariants of the Weil representation attached to the p-module FQM
+    over the prime field K without storing the matrix H of :func:`cython_invariants_matrices`.
+
+    The elements are sorted by their norms, so the rows of H belonging to the isotropic
+    elements come first. The remaining rows (the matrix U) are computed in blocks of
+    `block_size` rows directly from the bilinear forms of the isotropic elements,
+    and the kernel of U is computed as the intersection of the kernels of the blocks.
+    This needs memory for (block_size + ni) x ni entries instead of n x ni,
+    where ni is the number of isotropic elements modulo +-1.
+
+    By default, K is the finite field used by :func:`cython_invariants`.
+    The output is the same as for :func:`cython_invariants`.
+
+    EXAMPLES::
+
+        sage: A = FiniteQuadraticModule('3^-4')
+        sage: X = cython_invariants_blocked(A, block_size=7)
+        sage: X[1].dimension(), X == cython_invariants(A)
+        (1, True)
+    """
+    cdef long i, j, b0, b1
+    cdef long l = long(FQM.level())
+    cdef long n = long(FQM.order())
+    if not is_prime_power(l):
+        raise NotImplementedError('This function can only be called with p-modules.')
+    if K == None:
+        p = l
+        while p % lcm(4,l) != 1:
+            p = next_prime(p)
+        K = GF(p)
+    cdef long q = K.characteristic()
+    if q == 0 or 1 != q % l:
+        raise ValueError('K has to be a prime field of characteristic 1 modulo {0}.'.format(l))
+    if block_size < 1:
+        raise ValueError('block_size has to be positive.')
+    try:
+        s = FQM.sigma_invariant()
+        s2 = Integer( s**2)
+    except:
+        return span( [], K)
+    cdef long[:] table = np.ndarray(l, dtype=long)
+    _fill_table_modq(FQM, K, l, s, s2, table, debug)
+
+    fed = FQM.elementary_divisors()
+    cdef int r = len(fed)
+    cdef long* ed = <long*> sig_malloc(sizeof(long) * r)
+    cdef long** JJ = <long**> sig_calloc(r, sizeof(long*))
+    if ed is NULL or JJ is NULL:
+        sig_free(ed)
+        sig_free(JJ)
+        raise MemoryError('Cannot allocate memory.')
+    for i,d in enumerate(fed):
+        ed[i] = long(d)
+    J = FQM.__dict__['_FiniteQuadraticModule_ambient__J']
+    for i in xrange(r):
+        JJ[i] = <long*> sig_malloc(sizeof(long)*r)
+        if JJ[i] is NULL:
+            _free_buffers(ed, JJ, r, NULL, NULL, NULL)
+            raise MemoryError('Cannot allocate memory.')
+        for j in xrange(r):
+            JJ[i][j] = long((2*l*J[i,j]))
+
+    if debug > 0: t = walltime()
+    cdef long *Mli = <long*> sig_malloc(sizeof(long)*n)
+    cdef long *Mlj = <long*> sig_malloc(sizeof(long)*n)
+    cdef long *Mlm = <long*> sig_malloc(sizeof(long)*n)
+    if Mli is NULL or Mlj is NULL or Mlm is NULL:
+        _free_buffers(ed, JJ, r, Mli, Mlj, Mlm)
+        raise MemoryError('Cannot allocate memory.')
+    cdef bint all_reps = (s2 == 1)
+    with nogil:
+        n = _pm_representatives(n, l, all_reps, JJ, ed, r, Mli, Mlj, Mlm)
+    if n < 0:
+        _free_buffers(ed, JJ, r, Mli, Mlj, Mlm)
+        raise MemoryError('Cannot allocate memory.')
+    cdef long ni = 0
+    while ni < n and Mlj[ni] == 0:
+        ni = ni + 1
+    Ml = [(Mli[i], Mlj[i], Mlm[i]) for i in xrange(ni)]
+    if debug > 0: print '{0}: +- reps, n = {1}, ni = {2}'.format(walltime(t), n, ni)
+
+    # the linear forms B(x, .) of the isotropic representatives
+    cdef long* Bcol = <long*> sig_malloc(sizeof(long)*r*(ni+1))
+    if Bcol is NULL:
+        _free_buffers(ed, JJ, r, Mli, Mlj, Mlm)
+        raise MemoryError('Cannot allocate memory.')
+    for j in xrange(ni):
+        Bl(Mli[j], JJ, ed, r, Bcol + j*r)
+    for i in xrange(r):
+        sig_free(JJ[i])
+    sig_free(JJ)
+
+    # the remaining buffers are freed below, also if the linear algebra fails
+    cdef long[:,:] Hn
+    cdef int nt = num_threads if num_threads > 0 else openmp.omp_get_max_threads()
+    try:
+        Hn = np.zeros((ni, ni), dtype=long)
+        with nogil:
+            for i in xrange(ni):
+                for j in xrange(ni):
+                    Hn[i,j] = (table[(l - BBl(Mli[i], Bcol + j*r, ed, r)) % l]*Mlm[j]) % q
+                Hn[i,i] = (Hn[i,i] + 2) % q
+        V = _modn_matrix(K, Hn)
+
+        if debug > 0: t = walltime()
+        X = None
+        for b0 in xrange(ni, n, block_size):
+            b1 = min(b0 + block_size, n)
+            Hn = np.zeros((b1-b0, ni), dtype=long)
+            with nogil:
+                for i in prange(b1-b0, num_threads=nt, schedule='static'):
+                    for j in xrange(ni):
+                        Hn[i,j] = (table[(l - BBl(Mli[b0+i], Bcol + j*r, ed, r)) % l]*Mlm[j]) % q
+            U = _modn_matrix(K, Hn)
+            if X is None:
+                X = U.right_kernel_matrix().transpose()
+            else:
+                X = X*(U*X).right_kernel_matrix().transpose()
+            if debug > 1: print 'rows {0}-{1}: kernel of dimension {2}'.format(b0, b1, X.ncols())
+            if X.ncols() == 0:
+                break
+        if X is None:
+            X = Matrix(K, ni, ni, 1)
+        if debug > 0: print '{0}: kernel'.format(walltime(t))
+    finally:
+        sig_free(Bcol)
+        _free_buffers(ed, NULL, r, Mli, Mlj, Mlm)
+    return Ml, span([V*x for x in X.columns()], K)
+
+cpdef cython_invariants(FQM, use_reduction = True, proof = False, checks = False, debug=0, K = None, num_threads = 0, block_size = 0):
+    r"""
+    Computes the invariants of the Weil representation attached to FQM.
+
+    If `proof` is 'crt' and K is not given, the invariants are computed
+    by :func:`cython_invariants_crt`.
+    If `block_size` is positive and the computation takes place over a finite field
+    without proof, the invariants are computed by :func:`cython_invariants_blocked`,
+    which does not store the full matrix H.
+    """
+    if proof == 'crt' and K == None:
+        return cython_invariants_crt(FQM, debug=debug, num_threads=num_threads)
+    if block_size > 0 and not (proof or checks) and (use_reduction and K == None or K != None and K.characteristic() > 0):
+        return cython_invariants_blocked(FQM, K, block_size, debug=debug, num_threads=num_threads)
     if use_reduction and K == None:
         found = False
         p = FQM.level()
@@ -494,7 +1015,7 @@ cpdef cython_invariants(FQM, use_reduction = True, proof = False, checks = False
         if K == None:
             K = CyclotomicField(lcm(8,FQM.level()))
     if debug>0: print K, checks or proof
-    I = cython_invariants_matrices(FQM, K, proof = checks or proof, debug=debug)
+    I = cython_invariants_matrices(FQM, K, proof = checks or proof, debug=debug, num_threads=num_threads)
     if debug>0: print I
     if type(I)==list or type(I) == tuple:
         if not proof or K.characteristic() == 0:
@@ -552,30 +1073,259 @@ cpdef cython_invariants(FQM, use_reduction = True, proof = False, checks = False
     else:
         return Ml[:ni], Sp
 
-cpdef invariants(FQM, use_reduction = True, proof = False, checks=False, debug = 0):
-    #print 'use_reduction = ', use_reduction
-    I = cython_invariants(FQM, use_reduction, proof=proof, checks=checks, debug=debug)
+class IsotropicRepresentatives(object):
+    r"""
+    The representatives modulo +-1 of the isotropic elements of a finite quadratic module A
+    which index the invariants returned by :func:`invariants`.
+
+    The representatives are stored by their canonical indices
+    $x_0 + d_0(x_1 + d_1(x_2 + \cdots))$, where $(x_j)$ are the coordinates
+    with respect to the fundamental generators of A and $(d_j)$ are the elementary divisors.
+    The elements of A are only created when they are accessed.
+    Apart from that, this object behaves like the list of representatives.
+
+    EXAMPLES::
+
+        sage: A = FiniteQuadraticModule('5^2')
+        sage: R = invariants(A)[0]
+        sage: len(R), R.indices()
+        (5, array([ 0,  7,  8, 11, 14]))
+        sage: R[1] in R, R.index(R[3]), R.position(-R[3])
+        (True, 3, -1)
+    """
+
+    def __init__(self, A, indices):
+        self._A = A
+        self._ed = np.array([long(d) for d in A.elementary_divisors()], dtype=np.int64)
+        self._radix = np.cumprod(np.concatenate(([1], self._ed[:len(self._ed)-1]))).astype(np.int64)
+        self._indices = np.asarray(indices, dtype=np.int64)
+        # lookup table: the sorted indices and their positions
+        self._order = np.argsort(self._indices, kind='mergesort')
+        self._sorted = self._indices[self._order]
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __len__(self):
+        return len(self._indices)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        return self._A([long(c) for c in self.coordinates(i)])
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __contains__(self, x):
+        return self.position(x) >= 0
+
+    def indices(self):
+        r"""
+        Returns the canonical indices of the representatives as an array.
+        """
+        return self._indices
+
+    def coordinates(self, i = None):
+        r"""
+        Returns the coordinates of the i-th representative
+        with respect to the fundamental generators.
+        If i is None, returns the array of the coordinates of all representatives.
+        """
+        if i is None:
+            return (self._indices[:, None] // self._radix) % self._ed
+        return (self._indices[i] // self._radix) % self._ed
+
+    def encode(self, C):
+        r"""
+        Returns the canonical indices of the elements with coordinates
+        given by the rows of the integer array C.
+        """
+        return (np.asarray(C, dtype=np.int64) % self._ed).dot(self._radix)
+
+    def positions(self, indices):
+        r"""
+        Returns the array of the positions of the elements with the given canonical indices,
+        where -1 means that the element is not a representative.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(self._sorted) == 0:
+            return np.zeros(indices.shape, dtype=np.int64) - 1
+        k = np.searchsorted(self._sorted, indices)
+        k = np.minimum(k, len(self._sorted) - 1)
+        return np.where(self._sorted[k] == indices, self._order[k], -1)
+
+    def position(self, x):
+        r"""
+        Returns the position of the element x (or of the element with canonical index x)
+        or -1 if it is not a representative.
+        """
+        if not isinstance(x, (int, long, Integer)):
+            if x.parent() != self._A:
+                return -1
+            x = self.encode([x.list()])[0]
+        return long(self.positions([x])[0])
+
+    def index(self, x):
+        i = self.position(x)
+        if i < 0:
+            raise ValueError("{0} is not in list".format(x))
+        return i
+
+    def count(self, x):
+        return 1 if self.position(x) >= 0 else 0
+
+cpdef invariants(FQM, use_reduction = True, proof = False, checks=False, debug = 0, num_threads = 0, block_size = 0):
+    r"""
+    Returns the invariants of the Weil representation attached to FQM
+    as a pair consisting of the isotropic representatives modulo +-1
+    (see :class:`IsotropicRepresentatives`) and the space of invariants
+    with respect to the characteristic functions of these representatives.
+    """
+    I = cython_invariants(FQM, use_reduction, proof=proof, checks=checks, debug=debug, num_threads=num_threads, block_size=block_size)
     if type(I) == list or type(I) == tuple:
         Ml, Sp = I
     else:
         return I
-    Mll = list()
+    return IsotropicRepresentatives(FQM, [v[0] for v in Ml]), Sp
 
-    cdef long* ed = NULL
-    fed = FQM.elementary_divisors()
-    cdef int r = len(fed)
-    ed = <long*> sig_malloc(sizeof(long) * r)
-    for i,d in enumerate(FQM.elementary_divisors()):
-        ed[i] = long(d)
+cdef _orbit_groups(FQM):
+    r"""
+    Returns a list of pairs ((q, a), r) describing a diagonal form of the p-module FQM
+    for odd p: FQM has an orthogonal basis which contains exactly r vectors b
+    of order q with Q(b) = a/q for each pair.
+
+    The form is normalized such that a = 1 for all but at most one vector
+    in each Jordan constituent. This vector has a = t, where t is the smallest
+    quadratic non-residue modulo p.
+    """
+    groups = list()
+    for c in FQM.jordan_decomposition():
+        p, k, r, e = [Integer(x) for x in c[1][:4]]
+        q = p**k
+        t = Integer(2)
+        while kronecker(t, p) != -1:
+            t += 1
+        # the Jordan symbol is the Kronecker symbol of the determinant of 2*a
+        d = e*kronecker(2, p)**r
+        if d == 1:
+            groups.append(((q, 1), r))
+        else:
+            if r > 1:
+                groups.append(((q, 1), r - 1))
+            groups.append(((q, t), 1))
+    return groups
+
+cdef _arrangement_sum(cs, ds, w):
+    r"""
+    Returns the sum of the products w[c_1][d_1]*...*w[c_r][d_r]
+    over all distinct arrangements (c_1, ..., c_r) of the multiset cs.
+    """
+    vals = sorted(set(cs))
+    # sum over the arrangements of the first i entries,
+    # indexed by the multiplicities of the remaining values
+    states = {tuple(list(cs).count(v) for v in vals): 1}
+    for d in ds:
+        new_states = dict()
+        for rem, x in states.iteritems():
+            for j, v in enumerate(vals):
+                if rem[j] > 0:
+                    nrem = rem[:j] + (rem[j]-1,) + rem[j+1:]
+                    new_states[nrem] = new_states.get(nrem, 0) + x*w[v][d]
+        states = new_states
+    return states.values()[0]
 
-    cdef long* vv = NULL
-    for v in Ml:
-        vv = _elt(v[0],ed,r)
-        vvl = [vv[i] for i in range(r)]
-        Mll.append(FQM(vvl))
-        
-    return Mll, Sp
-            
-            
-            
-        
+cpdef cython_symmetric_invariants(FQM, K = None, debug = 0):
+    r"""
+    Computes the invariants of the Weil representation attached to the p-module FQM
+    ($p$ odd) which are constant on the orbits of a subgroup $G$ of the orthogonal group
+    (the symmetric invariants). In general, these are not all invariants.
+
+    Let $(b_i)$ be an orthogonal basis of FQM with normalized norms
+    (see :func:`_orbit_groups`). The group $G$ is generated by the sign changes
+    $b_i \mapsto -b_i$ and the permutations of basis vectors of the same order and norm.
+    An orbit of $G$ is given by the multisets of the absolute values of the coordinates
+    with respect to the vectors of each order and norm.
+
+    The characteristic functions of the orbits of $G$ span a subspace
+    that is invariant under the Weil representation. The invariants in this subspace
+    are computed from a matrix of size (number of orbits) x (number of isotropic orbits)
+    instead of (|FQM|/2) x (number of isotropic elements modulo +-1).
+    Their dimension is only a lower bound for the dimension of all invariants
+    (see the example of ``9^-2`` below), so this function is not used by
+    :func:`cython_invariants_dim` or :func:`invariants`; use these to compute all invariants.
+
+    The computation takes place over the field K, which has to contain
+    a primitive l-th root of unity, where l is the level of FQM.
+    By default, K is a finite field of characteristic 1 mod l.
+
+    OUTPUT:
+        - the list of the isotropic orbits, each given by a tuple of the multisets
+          (sorted tuples) for the pairs returned by :func:`_orbit_groups`,
+        - the space of invariants in terms of the characteristic functions of these orbits.
+
+    EXAMPLES::
+
+        sage: A = FiniteQuadraticModule('3^-4')
+        sage: orbits, V = cython_symmetric_invariants(A)
+        sage: len(orbits), V.dimension()
+        (3, 1)
+        sage: cython_symmetric_invariants(FiniteQuadraticModule('9^-2'))[1].dimension()
+        2
+        sage: cython_invariants_dim(FiniteQuadraticModule('9^-2'))
+        3
+    """
+    import itertools
+    l = Integer(FQM.level())
+    if not is_prime_power(l) or l % 2 == 0:
+        raise NotImplementedError('This function can only be called with p-modules for odd p.')
+    groups = _orbit_groups(FQM)
+    if K == None:
+        q = l + 1
+        while not is_prime(q) or q <= max([r for g, r in groups]):
+            q += l
+        K = GF(q)
+    if FQM.signature() % 4 != 0:
+        # the invariants are odd functions or zero
+        return [], span([], K)
+    if K.characteristic() > 0:
+        z = K.multiplicative_generator()**((K.order()-1)//l)
+    else:
+        z = K.zeta(l)
+    zl = [z**j for j in xrange(l)]
+    # s/sqrt(|FQM|) is the inverse of the Gauss sum
+    gs = K(1)
+    for (qq, a), r in groups:
+        gs *= sum([zl[(a*c**2*(l//qq)) % l] for c in xrange(qq)])**r
+    cf = 1/gs
+
+    if debug > 0: t = walltime()
+    per = [list(itertools.combinations_with_replacement(range((qq+1)//2), r)) for (qq, a), r in groups]
+    orbits = list(itertools.product(*per))
+    norms = [sum([a*(l//qq)*sum([c**2 for c in cs]) for ((qq, a), r), cs in zip(groups, o)]) % l for o in orbits]
+    iso = [o for o, n in zip(orbits, norms) if n == 0]
+    orbits = iso + [o for o, n in zip(orbits, norms) if n != 0]
+    ni = len(iso)
+    if debug > 0: print '{0}: {1} orbits, {2} isotropic'.format(walltime(t), len(orbits), ni)
+
+    # w[g][c][d] = sum of e(-B(x, y)) for x = +-c b, y = d b with b of type g
+    w = list()
+    for (qq, a), r in groups:
+        h = (qq+1)//2
+        w.append([[zl[(2*a*c*d*(l//qq)) % l] + zl[(-2*a*c*d*(l//qq)) % l] if c != 0 else K(1)
+                   for d in xrange(h)] for c in xrange(h)])
+    if debug > 0: t = walltime()
+    A = Matrix(K, len(orbits), ni)
+    for i, d in enumerate(orbits):
+        for j, o in enumerate(iso):
+            x = cf
+            for g, cs, ds in zip(w, o, d):
+                x *= _arrangement_sum(cs, ds, g)
+                if x == 0:
+                    break
+            A[i, j] = x
+        if i < ni:
+            A[i, i] -= 1
+    if debug > 0: print '{0}: matrix'.format(walltime(t))
+    return iso, A.right_kernel()
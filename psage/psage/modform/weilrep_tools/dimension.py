@@ -22,7 +22,8 @@ AUTHORS:
 
 #from psage.modules import *
 from sage.all import SageObject, Integer, RR, is_odd, next_prime, floor, \
-                     RealField, ZZ, ceil, log, ComplexField, real, sqrt, exp, round, imag
+                     RealField, ZZ, ceil, log, ComplexField, real, sqrt, exp, round, imag, \
+                     QQ, CyclotomicField, squarefree_part
 #import sys
 from .weight_one_half import *
 
@@ -40,6 +41,54 @@ def BB(x):
     onehalf = RF(1)/2
     return x - onehalf*(floor(x)-floor(-x))
 
+# Exact arithmetic in the real field Q(sqrt(2), sqrt(3)).
+# An element a + b*sqrt(2) + c*sqrt(3) + d*sqrt(6) is stored as the tuple (a, b, c, d).
+
+def _q23(a=0, b=0, c=0, d=0):
+    return (QQ(a), QQ(b), QQ(c), QQ(d))
+
+def _q23_add(x, y):
+    return tuple(a + b for a, b in zip(x, y))
+
+def _q23_mul(x, y):
+    a1, b1, c1, d1 = x
+    a2, b2, c2, d2 = y
+    return (a1*a2 + 2*b1*b2 + 3*c1*c2 + 6*d1*d2,
+            a1*b2 + b1*a2 + 3*c1*d2 + 3*d1*c2,
+            a1*c2 + c1*a2 + 2*b1*d2 + 2*d1*b2,
+            a1*d2 + d1*a2 + b1*c2 + c1*b2)
+
+def _q23_sqrt(r):
+    r"""
+      Returns the square root of the non-negative rational number r.
+      Raises a ValueError if it is not contained in $\QQ(\sqrt{2}, \sqrt{3})$.
+    """
+    r = QQ(r)
+    if r == 0:
+        return _q23()
+    a = r.numerator() * r.denominator()
+    f = squarefree_part(a)
+    if r < 0 or not f in [1, 2, 3, 6]:
+        raise ValueError("sqrt({0}) is not contained in QQ(sqrt(2), sqrt(3))".format(r))
+    x = [0, 0, 0, 0]
+    x[[1, 2, 3, 6].index(f)] = (a // f).sqrt() / r.denominator()
+    return _q23(*x)
+
+# cos(2 pi n / 24) for n = 0, ..., 6
+_q23_cos_table = [_q23(1), _q23(0, QQ(1)/4, 0, QQ(1)/4), _q23(0, 0, QQ(1)/2), _q23(0, QQ(1)/2),
+                  _q23(QQ(1)/2), _q23(0, -QQ(1)/4, 0, QQ(1)/4), _q23()]
+
+def _q23_cos(n):
+    r"""
+      Returns $\cos(2 \pi n / 24)$ for an integer n.
+    """
+    n = Integer(n) % 24
+    if n > 12:
+        n = 24 - n
+    if n > 6:
+        return tuple(-a for a in _q23_cos_table[12 - n])
+    return _q23_cos_table[n]
+
 class VectorValuedModularForms(SageObject):
     r"""
     Class representing a space of vector valued modular forms
@@ -110,6 +159,9 @@ class VectorValuedModularForms(SageObject):
         self._m = m
         self._alpha3 = None
         self._alpha4 = None
+        # weight independent data, computed on first use
+        self._vals = None
+        self._gauss_sums = None
 
     def __repr__(self):
         return "Vector valued modular forms for the Weil representation corresponding to: \n" + self._M.__repr__()
@@ -118,6 +170,18 @@ class VectorValuedModularForms(SageObject):
         return self._M
 
     def dimension(self,k,ignore=False, debug = 0):
+        r"""
+          Returns the dimension of the space of modular forms of weight k.
+
+          The formula is evaluated exactly: all irrational quantities
+          are contained in $\QQ(\sqrt{2}, \sqrt{3})$.
+
+          EXAMPLES::
+
+              sage: V = VectorValuedModularForms('3^-1', True)
+              sage: [V.dimension(k) for k in range(2, 15)]
+              [0, 1, 0, 1, 0, 1, 1, 2, 0, 2, 1, 2, 1]
+        """
         if k < 2 and not ignore:
             raise NotImplementedError("k has to >= 2")
         s = self._signature
@@ -133,14 +197,12 @@ class VectorValuedModularForms(SageObject):
             v2 = 1
 
         if self._g != None:
-            if not self._aniso_formula:
-                vals = self._g.values()
-            #else:
-                #print "using aniso_formula"
             M = self._g
         else:
-            vals = self._M.values()
             M = self._M
+        if self._vals is None:
+            self._vals = M.values()
+        vals = self._vals
 
         if (2*k+s)%4 == 0:
             d = Integer(1)/Integer(2)*(m+n2) # |dimension of the Weil representation on even functions|
@@ -151,18 +213,13 @@ class VectorValuedModularForms(SageObject):
             self._d = d
             self._alpha4 = 1/Integer(2)*(vals[0]-v2) # the codimension of SkL in MkL
             
-        prec = ceil(max(log(M.order(),2),52)+1)+17
-        #print prec
-        RR = RealField(prec)
-        CC = ComplexField(prec)
-        
         if debug > 0: print "d, m = {0}, {1}".format(d,m)
-        eps = exp( 2 * CC.pi() * CC(0,1) * (s + 2*k) / Integer(4) )
-        eps = round(real(eps))        
+        # eps = exp(2 pi i (s + 2k)/4)
+        eps = 1 if (2*k+s)%4 == 0 else -1
         if self._alpha3 is None or self._last_eps != eps:
             self._last_eps = eps
             if self._aniso_formula:
-                self._alpha4 = 1
+                RR = RealField(ceil(max(log(M.order(),2),52)+1)+17)
                 self._alpha3 = -sum([BB(a)*mm for a,mm in self._v2.iteritems() if a != 0])
                 #print self._alpha3
                 self._alpha3 += Integer(d) - Integer(1) - self._g.beta_formula()
@@ -174,39 +231,61 @@ class VectorValuedModularForms(SageObject):
                 self._alpha3 += sum([(1-a)*mm for a,mm in vals.iteritems() if a != 0])
                 #print self._alpha3
                 self._alpha3 = self._alpha3 / Integer(2)
+        if self._aniso_formula:
+            self._alpha4 = 1
         alpha3 = self._alpha3
         alpha4 = self._alpha4
         if debug > 0: print alpha3, alpha4
-        g1=M.char_invariant(1)
-        g1=CC(g1[0]*g1[1])
-        #print g1
-        g2=M.char_invariant(2)
-        g2=CC(g2[0]*g2[1])
-        if debug > 0: print g2, g2.parent()
-        g3=M.char_invariant(-3)
-        g3=CC(g3[0]*g3[1])
-        if debug > 0: print "eps = {0}".format(eps)
-        if debug > 0: print "d/4 = {0}, m/4 = {1}, e^(2pi i (2k+s)/8) = {2}".format(RR(d) / RR(4), sqrt(RR(m)) / RR(4), CC(exp(2 * CC.pi() * CC(0,1) * (2 * k + s) / Integer(8))))
-        if eps == 1:
-            g2_2 = real(g2)
-        else:
-            g2_2 = imag(g2)*CC(0,1)
-        alpha1 = RR(d) / RR(4) - sqrt(RR(m)) / RR(4)  * CC(exp(2 * CC.pi() * CC(0,1) * (2 * k + s) / Integer(8)) * g2_2)
-        if debug > 0: print alpha1
-        alpha2 = RR(d) / RR(3) + sqrt(RR(m)) / (3 * sqrt(RR(3))) * real(exp(CC(2 * CC.pi() * CC(0,1) * (4 * k + 3 * s - 10) / 24)) * (g1 + eps*g3))
-        if debug > 0: print "alpha1 = {0}, alpha2 = {1}, alpha3 = {2}, g1 = {3}, g2 = {4}, g3 = {5}, d = {6}, k = {7}, s = {8}".format(alpha1, alpha2, alpha3, g1, g2, g3, d, k, s)
-        dim = real(d + (d * k / Integer(12)) - alpha1 - alpha2 - alpha3)
+        if self._gauss_sums is None:
+            self._gauss_sums = [self._gauss_sum(c) for c in [1, 2, -3]]
+        (e1, g1), (e2, g2), (e3, g3) = self._gauss_sums
+        if debug > 0: print "eps = {0}, g1 = {1}, g2 = {2}, g3 = {3}".format(eps, (e1, g1), (e2, g2), (e3, g3))
+        # Here sqrt(m) * chi(c) = zeta_8^e_c * g_c (see _gauss_sum), so the real parts
+        # below are values of cos(2 pi n / 24) times g_c.
+        # alpha1 = d/4 - sqrt(m)/4 * Re(e((2k+s)/8) * g2)
+        alpha1 = _q23_add(_q23(d/4), _q23_mul(_q23(-QQ(1)/4), _q23_mul(_q23_cos(3*(2*k+s+e2)), g2)))
+        # alpha2 = d/3 + sqrt(m)/(3 sqrt(3)) * Re(e((4k+3s-10)/24) * (g1 + eps*g3))
+        n = 4*k + 3*s - 10
+        alpha2 = _q23_add(_q23_mul(_q23_cos(n + 3*e1), g1), _q23_mul(_q23(eps), _q23_mul(_q23_cos(n + 3*e3), g3)))
+        alpha2 = _q23_add(_q23(d/3), _q23_mul(_q23(0, 0, QQ(1)/9), alpha2))
+        if debug > 0: print "alpha1 = {0}, alpha2 = {1}, alpha3 = {2}, d = {3}, k = {4}, s = {5}".format(alpha1, alpha2, alpha3, d, k, s)
+        dim = _q23_add(_q23(d + d * k / Integer(12)), _q23_mul(_q23(-1), _q23_add(alpha1, alpha2)))
         if debug > 0:
-            print "dimension:", dim
-        if abs(dim-round(dim)) > 1e-6:
-            raise RuntimeError("Error ({0}) too large in dimension formula for {1} and k={2}".format(abs(dim-round(dim)), self._M if self._M is not None else self._g, k))
-        dimr = dim
-        dim = Integer(round(dim))
+            print "dimension:", dim, "-", alpha3
+        if dim[1:] != (0, 0, 0):
+            raise RuntimeError("Dimension formula for {0} and k={1} is not rational".format(self._M if self._M is not None else self._g, k))
+        dim = dim[0] - alpha3
+        if self._aniso_formula:
+            if abs(dim-round(dim)) > 1e-6:
+                raise RuntimeError("Error ({0}) too large in dimension formula for {1} and k={2}".format(abs(dim-round(dim)), self._g, k))
+            dim = Integer(round(dim))
+        if not dim in ZZ:
+            raise RuntimeError("Dimension formula for {0} and k={1} is not integral".format(self._M if self._M is not None else self._g, k))
+        dim = Integer(dim)
         if k >=2 and dim < 0:
-            raise RuntimeError("Negative dimension (= {0}, {1})!".format(dim, dimr))
+            raise RuntimeError("Negative dimension (= {0})!".format(dim))
         return dim
 
-    def dimension_cusp_forms(self, k, ignore=False, no_inv = False, test_positive = False, proof = False, debug=0):
+    def _gauss_sum(self, c):
+        r"""
+          Returns a pair (e, g) such that $\sqrt{|M|} \chi_M(c) = \zeta_8^e g$,
+          where $\chi_M$ is the characteristic function (see ``char_invariant``)
+          and g is a non-negative element of $\QQ(\sqrt{2}, \sqrt{3})$ (see :func:`_q23`).
+          This holds for the values at $c = 1, 2, -3$ needed in the dimension formula.
+        """
+        if self._g is not None:
+            E, R = self._g.char_invariants([c])
+            e, r = Integer(E[0]), QQ(R[0])
+        else:
+            ci, ci1 = self._M.char_invariant(c)
+            if ci == 0:
+                return 0, _q23()
+            z = CyclotomicField(8).gen()
+            e = [z**j for j in range(8)].index(ci)
+            r = QQ(ci1**2)
+        return e, _q23_sqrt(self._m * r)
+
+    def dimension_cusp_forms(self, k, ignore=False, no_inv = False, test_positive = False, proof = False, debug=0, block_size = 0):
         if debug>0:
             if self._g is not None:
                 print "Computing dimension for {}".format(self._g)
@@ -219,7 +298,7 @@ class VectorValuedModularForms(SageObject):
             if not test_positive or dim <= 0:
                 if self._M == None:
                     self._M = self._g.finite_quadratic_module()
-                corr = weight_one_half_dim(self._M, self._use_reduction, proof = proof)
+                corr = weight_one_half_dim(self._M, self._use_reduction, proof = proof, block_size = block_size)
                 if debug > 0: print "weight one half: {0}".format(corr)
                 dim += corr
         else:
@@ -231,11 +310,31 @@ class VectorValuedModularForms(SageObject):
                 self._M = self._g.finite_quadratic_module()
             if self._M.level() == 1:
                 return dim + 1
-            dinv = cython_invariants_dim(self._M,self._use_reduction)
+            dinv = cython_invariants_dim(self._M,self._use_reduction, block_size = block_size)
             dim = dim + dinv
         if dim < 0:
             raise RuntimeError("Negative dimension (= {0}, alpha4 = {1})!".format(dim, self._alpha4))
         return dim
+
+    def dimension_table(self, ks, ignore=False, debug=0):
+        r"""
+          Returns a dictionary mapping each weight k in ks to the dimension
+          of the space of modular forms of weight k.
+
+          The weight independent quantities (values, two torsion values,
+          Gauss sums and alpha3) are computed only once for all weights.
+        """
+        return dict((k, self.dimension(k, ignore, debug=debug)) for k in ks)
+
+    def dimension_cusp_forms_table(self, ks, ignore=False, no_inv = False, test_positive = False, proof = False, debug=0):
+        r"""
+          Returns a dictionary mapping each weight k in ks to the dimension
+          of the space of cusp forms of weight k.
+
+          See :meth:`dimension_table`; the arguments are as for :meth:`dimension_cusp_forms`.
+        """
+        return dict((k, self.dimension_cusp_forms(k, ignore, no_inv, test_positive, proof, debug))
+                    for k in ks)
         
 def test_real_quadratic(minp=1,maxp=100,minwt=2,maxwt=1000):
     for p in prime_range(minp,maxp):
@@ -0,0 +1,99 @@
+r"""
+A bounded cache for local invariants of the Weil representation.
+
+The dimension of the invariants of the Weil representation is multiplicative
+over the $p$-parts of a finite quadratic module. The same $p$-parts occur in
+many modules, so the local results are stored in a least recently used cache
+that is shared by :func:`cython_invariants_dim` and :func:`weight_one_half_dim`.
+
+The entries are keyed by the genus symbols of the local modules
+(see :meth:`JordanDecomposition.genus_symbol`) together with the flags
+that influence the computation.
+
+EXAMPLES::
+
+    sage: from psage.modform.weilrep_tools.local_cache import LocalInvariantsCache
+    sage: C = LocalInvariantsCache(2)
+    sage: C['a'] = 1; C['b'] = 2
+    sage: C.get('a')
+    1
+    sage: C['c'] = 3
+    sage: C.get('b') is None
+    True
+    sage: C.info()
+    CacheInfo(hits=1, misses=1, maxsize=2, currsize=2)
+"""
+
+from collections import OrderedDict, namedtuple
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class LocalInvariantsCache(object):
+    r"""
+      A dictionary holding at most ``maxsize`` entries.
+      If it is full, the least recently used entry is discarded.
+    """
+
+    def __init__(self, maxsize=2**14):
+        self._maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "Cache of local invariants with {0} of at most {1} entries".format(len(self._data), self._maxsize)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        # does not count as a hit or miss
+        return key in self._data
+
+    def get(self, key, default=None):
+        r"""
+          Returns the value stored for key and marks it as recently used.
+          Returns default if key is not contained in the cache.
+        """
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        self._shrink()
+
+    def _shrink(self):
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def resize(self, maxsize):
+        r"""
+          Sets the maximal number of entries to maxsize.
+        """
+        self._maxsize = maxsize
+        self._shrink()
+
+    def info(self):
+        r"""
+          Returns the number of hits and misses,
+          the maximal and the current number of entries.
+        """
+        return CacheInfo(self.hits, self.misses, self._maxsize, len(self._data))
+
+    def clear(self):
+        r"""
+          Removes all entries and resets the statistics.
+        """
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+local_invariants_cache = LocalInvariantsCache()
@@ -1,10 +1,14 @@
 from sage.all import SageObject, Integer, RR, is_odd, next_prime, floor, RealField, ZZ, ceil, log, ComplexField, real, sqrt, exp, is_squarefree, lcm, Matrix, cached_function
 from psage.modules.finite_quadratic_module import FiniteQuadraticModule
-from psage.external.weil_invariants.weil_invariants import invariants
+from psage.external.weil_invariants.weil_invariants import invariants, cython_local_invariants_dim
+from psage.modform.weilrep_tools.local_cache import local_invariants_cache
+from psage.modform.weilrep_tools.weight_one_half_atlas import weight_one_half_atlas
+from sage.parallel.decorate import parallel
 from copy import copy
+import numpy as np
 
 @cached_function
-def invariants_eps(FQM, TM, use_reduction = True, proof = False, debug = 0):
+def invariants_eps(FQM, TM, use_reduction = True, proof = False, debug = 0, block_size = 0):
     r"""
     Computes the invariants of a direct summand in the decomposition for weight
     one-half modular forms. Such a summand is of the form
@@ -17,6 +21,8 @@ def invariants_eps(FQM, TM, use_reduction = True, proof = False, debug = 0):
     INPUT:
         - FQM: A given finite quadratic module, referred to as $M$ above
         - TM: A cyclic module of the form as given abve (the first factor)
+        - block_size: if positive, the invariants are computed in row blocks of this size
+          (see :func:`cython_invariants_blocked`)
 
     NOTE:
         We do not check that TM is of the stated form. The function is an auxiliary function
@@ -39,7 +45,7 @@ def invariants_eps(FQM, TM, use_reduction = True, proof = False, debug = 0):
         debug2 = 1
     if debug > 2:
         debug2=debug
-    inv = invariants(TMM, use_reduction, proof=proof, debug=debug2)
+    inv = invariants(TMM, use_reduction, proof=proof, debug=debug2, block_size=block_size)
     if debug > 1: print inv
     if type(inv) in [list,tuple]:
         V = inv[1]
@@ -51,21 +57,30 @@ def invariants_eps(FQM, TM, use_reduction = True, proof = False, debug = 0):
         M = Matrix(V.base_ring(), V.ambient_module().dimension())
         if eps:
             f = 1 if TMM.signature() % 4 == 0 else -1
-            for v in inv[0]:
-                #Get the coordinate of this isotropic element
-                vv = v.c_list()
-                #change the first coordinate to its negative (the eps-action)
+            R = inv[0]
+            #the eps-action changes the sign of the first coordinate
+            #with respect to the generators of TMM;
+            #we compute its matrix with respect to the fundamental generators
+            E = list()
+            for g in TMM.fgens():
+                vv = g.c_list()
                 vv[0] = -vv[0]
-                vv = TMM(vv,can_coords=True)
-                #since the isotropic elements are taken up to the action of +-1, we need to check
-                #if we have this element (vv) or its negative (-vv) in the list
-                #we append the index of the match, together with a sign to the list `el`,
-                #where the sign is -1 if -vv is in inv[0] and the signature is 2 mod 4
-                #(i.e. the std generator of the center acts as -1)
-                if inv[0].count(vv) > 0:
-                    el.append((inv[0].index(vv),1))
+                E.append(TMM(vv,can_coords=True).list())
+            C = R.coordinates().dot(np.array(E, dtype=np.int64))
+            #since the isotropic elements are taken up to the action of +-1, we need to check
+            #if we have the image of an element (vv) or its negative (-vv) in the list
+            #we append the index of the match, together with a sign to the list `el`,
+            #where the sign is -1 if -vv is in inv[0] and the signature is 2 mod 4
+            #(i.e. the std generator of the center acts as -1)
+            pos = R.positions(R.encode(C))
+            neg = R.positions(R.encode(-C))
+            for i in range(len(R)):
+                if pos[i] >= 0:
+                    el.append((int(pos[i]),1))
+                elif neg[i] >= 0:
+                    el.append((int(neg[i]),f))
                 else:
-                    el.append((inv[0].index(-vv),f))
+                    raise RuntimeError("The image of {0} under eps is not isotropic.".format(R[i]))
             #We create the entries of the matrix M
             #which acts as eps on the space spanned by the isotropic vectors (mod +-1)
             for i in range(len(el)):
@@ -86,58 +101,148 @@ def invariants_eps(FQM, TM, use_reduction = True, proof = False, debug = 0):
     if debug > 1: print d
     return d
 
+def _local_module(J, p, n):
+    r"""
+    Returns the direct sum of the Jordan constituents of exponent $p^j$, $j \leq n$,
+    of the Jordan decomposition J or None if there are none.
+    """
+    N = None
+    for j in xrange(1,n+1):
+        C = J.constituent(p**j)[0]
+        if N == None and C.level() != 1:
+            N = C
+        elif C.level() != 1:
+            N = N + C
+    return N
+
 @cached_function
-def weight_one_half_dim(FQM, use_reduction = True, proof = False, debug = 0, local=True):
+def weight_one_half_dim(FQM, use_reduction = True, proof = False, debug = 0, local=True, ncpus = 1, block_size = 0):
+    r"""
+    Returns the dimension of the space of modular forms of weight one-half
+    attached to FQM.
+
+    If `local` is True, the dimension is computed from the local invariants.
+    The Jordan decomposition and the local parts of FQM are computed only once.
+    The local results are kept in the cache ``local_invariants_cache``
+    from :mod:`psage.modform.weilrep_tools.local_cache`,
+    which is shared with :func:`cython_invariants_dim`.
+    Local results contained in the atlas (see
+    :mod:`psage.modform.weilrep_tools.weight_one_half_atlas`) are not recomputed.
+    If `ncpus` is larger than 1, the local results which are not in the cache
+    are computed in parallel by `ncpus` processes.
+    If `block_size` is positive, the invariants are computed in row blocks of this size
+    (see :func:`cython_invariants_blocked`).
+
+    EXAMPLES::
+
+        sage: from psage.modform.weilrep_tools.local_cache import local_invariants_cache
+        sage: F = FiniteQuadraticModule('4_1^1.3^-1')
+        sage: d = weight_one_half_dim(F)
+        sage: local_invariants_cache.clear()
+        sage: weight_one_half_dim(F, ncpus=2) == d
+        True
+    """
     N = Integer(FQM.level())
     if not N % 4 == 0:
         return 0
     m = Integer(N/Integer(4))
     d = 0
-    for l in m.divisors():
-        if is_squarefree(m/l):
+    ls = [l for l in m.divisors() if is_squarefree(m/l)]
+    if not local:
+        for l in ls:
             if debug > 1: print "l = {0}".format(l)
             TM = FiniteQuadraticModule([2*l],[-1/Integer(4*l)])
-            if local:
-                dd = [0,0] # eigenvalue 1, -1 multiplicity
-                for p,n in lcm(FQM.level(),4*l).factor():
-                    N = None
-                    TN = None
-                    J = FQM.jordan_decomposition()
-                    L = TM.jordan_decomposition()
-                    for j in xrange(1,n+1):
-                        C = J.constituent(p**j)[0]
-                        D = L.constituent(p**j)[0]
-                        if debug > 1: print "C = {0}, D = {1}".format(C,D)
-                        if N == None and C.level() != 1:
-                            N = C
-                        elif C.level() != 1:
-                            N = N + C
-                        if TN == None and D.level() != 1:
-                            TN = D
-                        elif D.level() != 1:
-                            TN = TN + D
-                    dd1 = invariants_eps(N, TN, use_reduction, proof, debug)
-                    if debug > 1: print "dd1 = {}".format(dd1)
-                    if dd1 == [0,0]:
-                        # the result is multiplicative
-                        # a single [0,0] as a local result
-                        # yields [0,0] in the end
-                        # and we're done here
-                        dd = [0,0]
-                        break
-                    if dd == [0,0]:
-                        # this is the first prime
-                        dd = dd1
-                    else:
-                        # some basic arithmetic ;-)
-                        # 1 = 1*1 = (-1)(-1)
-                        # -1 = 1*(-1) = (-1)*1
-                        ddtmp = copy(dd)
-                        ddtmp[0] = dd[0]*dd1[0] + dd[1]*dd1[1]
-                        ddtmp[1] = dd[0]*dd1[1] + dd[1]*dd1[0]
-                        dd = ddtmp
-                    if debug > 1: print "dd = {0}".format(dd)
-                d += dd[0]
+            d += invariants_eps(FQM, TM, use_reduction, proof, debug, block_size)[0]
+        return d
+
+    J = FQM.jordan_decomposition()
+    parts = dict() # the local parts of FQM
+    pairs = dict() # key -> (p, l, n) for the pairs of local modules
+    keys = dict() # l -> list of (p, key), where key is None if TM is trivial at p
+    for l in ls:
+        TM = FiniteQuadraticModule([2*l],[-1/Integer(4*l)])
+        L = TM.jordan_decomposition()
+        keys[l] = list()
+        for p,n in lcm(FQM.level(),4*l).factor():
+            if not p.divides(4*l):
+                keys[l].append((p, None))
+            else:
+                key = ('eps', J.genus_symbol(p), L.genus_symbol(p), use_reduction, proof)
+                keys[l].append((p, key))
+                if not key in pairs:
+                    pairs[key] = (p, n, L)
+
+    def local_eps(key):
+        p, n, L = pairs[key]
+        if not p in parts:
+            parts[p] = _local_module(J, p, n)
+        TN = _local_module(L, p, n)
+        if debug > 1: print "N = {0}, TN = {1}".format(parts[p], TN)
+        return invariants_eps(parts[p], TN, use_reduction, proof, debug, block_size)
+
+    results = dict()
+    atlas = weight_one_half_atlas()
+    if atlas is not None:
+        for key in pairs:
+            if not key in local_invariants_cache:
+                # the atlas does not depend on use_reduction (key[3]),
+                # which only changes how the invariants are computed
+                dd1 = atlas.get(key[1], key[2], proof)
+                if dd1 is not None:
+                    results[key] = dd1
+                    local_invariants_cache[key] = dd1
+    missing = [key for key in pairs if not key in local_invariants_cache]
+    if ncpus > 1 and len(missing) > 1:
+        # build the local parts before the processes are forked
+        for key in missing:
+            p, n, L = pairs[key]
+            if not p in parts:
+                parts[p] = _local_module(J, p, n)
+        @parallel(ncpus=ncpus)
+        def _local_eps(key):
+            return local_eps(key)
+        # the keys are tuples, so they have to be wrapped as the arguments of _local_eps
+        for (args, kwds), dd1 in _local_eps([((key,), {}) for key in missing]):
+            # a failed process returns 'NO DATA',
+            # then the result is computed again below
+            if isinstance(dd1, (list, tuple)) and len(dd1) == 2:
+                results[args[0]] = dd1
+                local_invariants_cache[args[0]] = dd1
+
+    for l in ls:
+        if debug > 1: print "l = {0}".format(l)
+        dd = [0,0] # eigenvalue 1, -1 multiplicity
+        for p, key in keys[l]:
+            if key is None:
+                # the local factor of TM is trivial
+                dd1 = [cython_local_invariants_dim(FQM, p, J, use_reduction, proof, block_size=block_size), 0]
+            else:
+                dd1 = results.get(key)
+                if dd1 is None:
+                    dd1 = local_invariants_cache.get(key)
+                if dd1 is None:
+                    dd1 = local_eps(key)
+                    local_invariants_cache[key] = dd1
+                dd1 = list(dd1)
+            if debug > 1: print "dd1 = {}".format(dd1)
+            if dd1 == [0,0]:
+                # the result is multiplicative
+                # a single [0,0] as a local result
+                # yields [0,0] in the end
+                # and we're done here
+                dd = [0,0]
+                break
+            if dd == [0,0]:
+                # this is the first prime
+                dd = dd1
             else:
-                d += invariants_eps(FQM, TM, use_reduction, proof, debug)[0]
+                # some basic arithmetic ;-)
+                # 1 = 1*1 = (-1)(-1)
+                # -1 = 1*(-1) = (-1)*1
+                ddtmp = copy(dd)
+                ddtmp[0] = dd[0]*dd1[0] + dd[1]*dd1[1]
+                ddtmp[1] = dd[0]*dd1[1] + dd[1]*dd1[0]
+                dd = ddtmp
+            if debug > 1: print "dd = {0}".format(dd)
+        d += dd[0]
     return d
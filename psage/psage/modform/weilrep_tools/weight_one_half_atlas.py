@@ -0,0 +1,280 @@
+r"""
+An atlas of the local results needed by :func:`weight_one_half_dim`.
+
+For a local module N (a $p$-module) and the $p$-part TN of a cyclic module
+$(\mathbb{Z}/2l\mathbb{Z}, -x^2/4l)$, the function :func:`invariants_eps` returns the
+multiplicities [d+, d-] of the eigenvalues 1 and -1. The atlas stores these
+multiplicities for all local modules N up to given orders. It is generated once by
+:func:`generate_weight_one_half_atlas` and then used by :func:`weight_one_half_dim`
+before any linear algebra is done.
+
+The atlas is a gzip compressed text file. It starts with a header consisting of the lines
+``version <v>``, ``proof <0 or 1>`` and ``bound <p> <q>`` for each prime p, and
+contains one line ``<symbol of N> <symbol of TN> <d+> <d->`` for each pair.
+The symbols are the genus symbols of the Jordan decompositions
+(see :meth:`JordanDecomposition.genus_symbol`).
+
+The results do not depend on the flag ``use_reduction`` of :func:`invariants_eps`
+(it only changes the way the invariants are computed), so it is not part of the keys.
+
+The atlas shipped with the package is stored in ``data/weight_one_half_atlas.txt.gz``
+(see ``DEFAULT_ATLAS``). It contains all pairs for the odd primes $p$ and the local modules N
+of order at most $3^4$, $5^3$, $7^2$, $11^2$ and $13^2$. These results have been computed independently
+of :func:`invariants` (by floating point and modular linear algebra) and are not proven.
+For $p = 2$, the genus symbols returned by :meth:`JordanDecomposition.genus_symbol` are
+not canonical, so 2-adic results are only useful in an atlas generated by
+:func:`generate_weight_one_half_atlas`, whose keys are computed by the same code.
+
+Another atlas may be used by :func:`set_weight_one_half_atlas` or by setting the environment
+variable ``PSAGE_WEIGHT_ONE_HALF_ATLAS`` to its file name.
+
+EXAMPLES::
+
+    sage: from psage.modform.weilrep_tools.weight_one_half_atlas import *
+    sage: from psage.modform.weilrep_tools.weight_one_half import weight_one_half_dim
+    sage: from psage.modform.weilrep_tools.local_cache import local_invariants_cache
+    sage: weight_one_half_atlas()
+    Weight one-half atlas (version 1) with 212 entries
+    sage: weight_one_half_atlas().get('9', '9^-1')
+    [2, 1]
+    sage: F = FiniteQuadraticModule('4_1^1.3^-1')
+    sage: set_weight_one_half_atlas(None)
+    sage: d = weight_one_half_dim(F)
+    sage: fn = tmp_filename(ext='.txt.gz')
+    sage: A = generate_weight_one_half_atlas(fn, {2: 16, 3: 9})
+    sage: len(load_weight_one_half_atlas(fn)) == len(A) > 0
+    True
+    sage: for atlas in [fn, DEFAULT_ATLAS]:
+    ....:     set_weight_one_half_atlas(atlas)
+    ....:     local_invariants_cache.clear(); weight_one_half_dim.clear_cache()
+    ....:     print weight_one_half_dim(F) == d
+    True
+    True
+"""
+
+import os
+import gzip
+import itertools
+from sage.all import Integer, kronecker
+from psage.modules.finite_quadratic_module import FiniteQuadraticModule
+
+ATLAS_VERSION = 1
+DEFAULT_ATLAS = os.path.join(os.path.dirname(__file__), 'data', 'weight_one_half_atlas.txt.gz')
+
+
+class WeightOneHalfAtlas(object):
+    r"""
+      The local results [d+, d-] of :func:`invariants_eps`, keyed by the genus symbols
+      of the local modules.
+    """
+
+    def __init__(self, data=None, bounds=None, proof=False, version=ATLAS_VERSION):
+        self._data = dict() if data is None else data
+        self._bounds = dict() if bounds is None else bounds
+        self._proof = proof
+        self._version = version
+
+    def __repr__(self):
+        return "Weight one-half atlas (version {0}) with {1} entries".format(self._version, len(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def bounds(self):
+        r"""
+          Returns the dictionary mapping each prime p to the bound
+          for the orders of the local modules N.
+        """
+        return self._bounds
+
+    def get(self, N, TN, proof=False):
+        r"""
+          Returns the multiplicities [d+, d-] for the local modules with genus symbols N and TN
+          or None if they are not contained in the atlas (or if proof is True
+          and the atlas does not contain proven results).
+        """
+        if proof and not self._proof:
+            return None
+        d = self._data.get((N, TN))
+        return None if d is None else list(d)
+
+    def __setitem__(self, key, d):
+        self._data[key] = tuple(d)
+
+    def save(self, filename):
+        r"""
+          Writes the atlas to the file filename.
+        """
+        f = gzip.open(filename, 'wb')
+        try:
+            f.write("version {0}\n".format(self._version))
+            f.write("proof {0}\n".format(int(bool(self._proof))))
+            for p in sorted(self._bounds):
+                f.write("bound {0} {1}\n".format(p, self._bounds[p]))
+            for (N, TN), d in sorted(self._data.iteritems()):
+                f.write("{0} {1} {2} {3}\n".format(N, TN, d[0], d[1]))
+        finally:
+            f.close()
+
+
+def load_weight_one_half_atlas(filename):
+    r"""
+      Reads the atlas stored in the file filename.
+      Raises a ValueError if the file has an unsupported version.
+    """
+    A = WeightOneHalfAtlas()
+    f = gzip.open(filename, 'rb')
+    try:
+        for line in f:
+            w = line.split()
+            if len(w) == 0:
+                continue
+            if w[0] == 'version':
+                A._version = int(w[1])
+                if A._version != ATLAS_VERSION:
+                    raise ValueError("Unsupported version {0} of the atlas {1}.".format(A._version, filename))
+            elif w[0] == 'proof':
+                A._proof = bool(int(w[1]))
+            elif w[0] == 'bound':
+                A._bounds[Integer(w[1])] = Integer(w[2])
+            else:
+                A._data[(w[0], w[1])] = (int(w[2]), int(w[3]))
+    finally:
+        f.close()
+    return A
+
+_atlas = None
+_atlas_initialized = False
+
+
+def weight_one_half_atlas():
+    r"""
+      Returns the atlas that is currently used, or None if there is none.
+    """
+    global _atlas, _atlas_initialized
+    if not _atlas_initialized:
+        filename = os.environ.get('PSAGE_WEIGHT_ONE_HALF_ATLAS')
+        if not filename:
+            filename = DEFAULT_ATLAS
+        _atlas = load_weight_one_half_atlas(filename) if os.path.exists(filename) else None
+        _atlas_initialized = True
+    return _atlas
+
+
+def set_weight_one_half_atlas(filename):
+    r"""
+      Use the atlas stored in the file filename.
+      If filename is None, no atlas is used.
+    """
+    global _atlas, _atlas_initialized
+    _atlas = load_weight_one_half_atlas(filename) if filename is not None else None
+    _atlas_initialized = True
+
+
+def local_modules(p, bound):
+    r"""
+      Returns a dictionary mapping the genus symbols to representatives
+      of the nondegenerate $p$-modules of order at most bound.
+      Modules with several genus symbols may occur several times.
+    """
+    modules = dict()
+    n = Integer(bound).exact_log(p)
+    # the exponents k of the constituents p^k with their ranks r,
+    # such that the order is at most p^n
+    def constituents(k0, n):
+        yield []
+        for k in xrange(k0, n+1):
+            for r in xrange(1, n//k + 1):
+                for c in constituents(k+1, n - k*r):
+                    yield [(k, r)] + c
+    for c in constituents(1, n):
+        if c == []:
+            continue
+        choices = list()
+        for k, r in c:
+            q = p**k
+            ch = ['{0}^{1}'.format(q, r), '{0}^-{1}'.format(q, r)]
+            if p == 2:
+                ch += ['{0}_{1}^{2}{3}'.format(q, t, e, r) for t in xrange(8) for e in ['', '-']]
+            choices.append(ch)
+        for s in itertools.product(*choices):
+            try:
+                A = FiniteQuadraticModule('.'.join(s))
+            except ValueError:
+                # not a valid symbol
+                continue
+            modules.setdefault(A.jordan_decomposition().genus_symbol(p), A)
+    return modules
+
+
+def local_cyclic_factors(p, bound):
+    r"""
+      Returns a dictionary mapping the genus symbols to the $p$-parts of the modules
+      $(\mathbb{Z}/2l\mathbb{Z}, -x^2/4l)$ used by :func:`weight_one_half_dim`
+      whose level has $p$-part at most bound.
+    """
+    from psage.modform.weilrep_tools.weight_one_half import _local_module
+    factors = dict()
+    # the p-part only depends on the p-part of l
+    # and the class of l/p^a modulo squares (modulo 8 if p = 2)
+    if p == 2:
+        units = [1, 3, 5, 7]
+    else:
+        u = Integer(2)
+        while kronecker(u, p) != -1:
+            u += 1
+        units = [1, u]
+    a = 0
+    while (4 if p == 2 else 1)*p**a <= bound:
+        for u in units:
+            l = p**a*u
+            TM = FiniteQuadraticModule([2*l], [-1/Integer(4*l)])
+            L = TM.jordan_decomposition()
+            TN = _local_module(L, p, Integer(4*l).valuation(p))
+            if TN is not None:
+                factors.setdefault(L.genus_symbol(p), TN)
+        a += 1
+    return factors
+
+
+def generate_weight_one_half_atlas(filename, bounds, use_reduction=True, proof=False, ncpus=1):
+    r"""
+      Computes the atlas for the local modules N of order at most bounds[p]
+      for each prime p in the dictionary bounds, writes it to the file filename and returns it.
+
+      For each N, all cyclic factors TN (see :func:`local_cyclic_factors`)
+      whose level divides the level of N are considered.
+    """
+    from psage.modform.weilrep_tools.weight_one_half import invariants_eps
+    from sage.parallel.decorate import parallel
+    A = WeightOneHalfAtlas(bounds=dict((Integer(p), Integer(b)) for p, b in bounds.iteritems()), proof=proof)
+    pairs = dict()
+    for p, b in A.bounds().iteritems():
+        Ns = local_modules(p, b)
+        TNs = local_cyclic_factors(p, max([N.level() for N in Ns.values()] + [1]))
+        for sN, N in Ns.iteritems():
+            for sTN, TN in TNs.iteritems():
+                if N.level() % TN.level() == 0:
+                    pairs[(sN, sTN)] = (N, TN)
+
+    keys = sorted(pairs.keys())
+    if ncpus > 1 and len(keys) > 1:
+        @parallel(ncpus=ncpus)
+        def _local_eps(key):
+            N, TN = pairs[key]
+            return invariants_eps(N, TN, use_reduction, proof)
+        # the keys are tuples, so they have to be wrapped as the arguments of _local_eps
+        for (args, kwds), d in _local_eps([((key,), {}) for key in keys]):
+            # a failed process returns 'NO DATA',
+            # then the result is computed again below
+            if isinstance(d, (list, tuple)) and len(d) == 2:
+                A[args[0]] = d
+    for key in keys:
+        if not key in A:
+            N, TN = pairs[key]
+            A[key] = invariants_eps(N, TN, use_reduction, proof)
+    A.save(filename)
+    return A
@@ -1,2 +1,2 @@
 from finite_quadratic_module import FiniteQuadraticModule,FiniteQuadraticModule
-from psage.external.weil_invariants.weil_invariants import cython_invariants, invariants, cython_invariants_matrices, cython_invariants_dim
+from psage.external.weil_invariants.weil_invariants import cython_invariants, invariants, cython_invariants_matrices, cython_invariants_dim, cython_local_invariants_dim, local_invariants_dim, cython_invariants_crt, cython_invariants_blocked
@@ -86,6 +86,7 @@ AUTHORS:
 TODO: Lots and lots of examples. 
 """
 
+import itertools
 from sage.functions.other                 import floor
 from sage.arith.all                       import divisors, is_prime, kronecker, lcm, gcd, prime_divisors, primitive_root, is_square, is_prime_power, inverse_mod, binomial
 from sage.rings.all                       import ZZ, QQ, Integer, PolynomialRing,CC
@@ -1019,24 +1020,17 @@ class FiniteQuadraticModule_ambient (AbelianGroup):
             raise ValueError("c has to be an integer.")
         if gcd(c,self.order())==1:
             return self.subgroup([])
-        l=[]
-        for x in self:
-            y = c*x
-            if y==self(0):
-                l.append(x)
-        return self.subgroup(l)
+        X = self.elements_array()
+        return self.subgroup(list(X[(X*c).indices() == 0]))
 
     def power_subgroup(self,c):
         r"""
         Compute the subgroup D^c={c*x | x in D}
         
         """
-        l=[]
-        for x in self:
-            y = c*x
-            if y not in l:
-                l.append(y)
-        return self.subgroup(l)
+        import numpy as np
+        X = self.elements_array()*c
+        return self.subgroup(list(FiniteQuadraticModuleElementArray.from_indices(self, np.unique(X.indices()))))
 
     def power_subset_star(self,c):
         r"""    
@@ -1271,27 +1265,93 @@ class FiniteQuadraticModule_ambient (AbelianGroup):
         OUTPUT
             dictionary -- the mapping Q(x) --> the number of elements x with the same value Q(x)
 
-        EXAMPLES NONE
-##             sage: A=FiniteQuadraticModule([1,3])
-##             sage: A.values()[7/12]
-##             2
+        EXAMPLES
+            sage: A = FiniteQuadraticModule([1,3])
+            sage: A.values()[7/12]
+            2
 
-        TODO
-            Replace the code by theoretical formulas
-            using the Jordan decomposition.
-            DONE: See the values function in the class JordanDecomposition  
+        NOTE
+            The values are counted by :meth:`value_histogram`.
+            See also the values function in the class JordanDecomposition,
+            which uses theoretical formulas.
         """
-        valueDict = {}
-        
-        for x in self:
-            v= self.Q( x )
-            if valueDict.has_key( v ):
-                valueDict[v] +=1
-            else:
-                valueDict[v] = 1
-                
-        return valueDict
-    
+        h = self.value_histogram()
+        D = len(h)
+        return dict( (Integer(k)/D, Integer(h[k])) for k in range(D) if h[k] != 0)
+
+
+    def value_histogram( self, block_size = 2**20):
+        r"""
+        Return an array h of length $D = 2\cdot$ level such that $h[k]$ is the number of $x \in M$
+        with $Q(x) = k/D$.
+
+        The elements are enumerated as coordinate arrays with respect to the fundamental generators
+        in blocks of at most block_size elements and $D\cdot Q(x)$ is computed modulo $D$ using
+        the integral matrix $D\cdot J$ (so only $O(block\_size)$ memory is used).
+
+        EXAMPLES
+            sage: A = FiniteQuadraticModule([1,3])
+            sage: h = A.value_histogram(block_size = 5); len(h), h.sum()
+            (24, 12)
+            sage: list(h.nonzero()[0])
+            [0, 2, 6, 8, 14, 18]
+        """
+        import numpy as np
+        D = self._integral_gram()[0]
+        N = long( self.order())
+        h = np.zeros( long(D), dtype = np.int64)
+        block_size = max( 1, long(block_size))
+        for start in xrange( 0, N, block_size):
+            X = self.elements_array( start, min( N, start + block_size))
+            h += np.bincount( X.Q(), minlength = D)
+        return h
+
+
+    def elements_array( self, start = 0, stop = None):
+        r"""
+        Return the elements of self whose packed indices (see :class:`FiniteQuadraticModuleElementArray`)
+        lie in range(start, stop) as a FiniteQuadraticModuleElementArray.
+        If stop is not set, it is the order of self.
+
+        EXAMPLES
+            sage: A = FiniteQuadraticModule([1,3])
+            sage: X = A.elements_array(); len(X)
+            12
+            sage: X[7].list()
+            [1, 3]
+        """
+        import numpy as np
+        if stop is None:
+            stop = self.order()
+        return FiniteQuadraticModuleElementArray.from_indices( self, np.arange( long(start), long(stop), dtype = np.int64))
+
+
+    @cached_method
+    def _integral_gram( self):
+        r"""
+        Return the pair $(D, A)$, where $D = 2\cdot$ level and $A = D\cdot J \bmod D$ as an int64 array,
+        $J$ being the Gram matrix w.r.t. the fundamental generators.
+        Hence $D\cdot Q(x) \equiv x^tAx \bmod D$ for the fundamental coordinates $x$.
+        """
+        import numpy as np
+        D = 2*self.level()
+        J = D*self.__J
+        if any( a not in ZZ for a in J.list()):
+            raise ArithmeticError, "the Gram matrix is not integral at level %s" % self.level()
+        # reduce D*J mod D so that the products of coordinates fit into int64
+        return D, np.array( [[long(a % D) for a in r] for r in J.rows()], dtype = np.int64)
+
+
+    def _c2f_array( self, C):
+        r"""
+        Transform an array of coordinates w.r.t. the generators (one row for each element)
+        to coordinates w.r.t. the internal fundamental system.
+        """
+        import numpy as np
+        T = np.array( [[long(a) for a in r] for r in self.__C2F.transpose().rows()], dtype = np.int64)
+        ed = np.array( [long(e) for e in self.elementary_divisors()], dtype = np.int64)
+        return np.asarray( C, dtype = np.int64).dot(T) % ed
+
 
     def subgroups( self, d = None  ):
         r"""
@@ -1352,7 +1412,7 @@ class FiniteQuadraticModule_ambient (AbelianGroup):
             Introduce optional arguments which allow to iterate in addition effectively
             over all subgroups contained in or containig a certain subgroup, being isotropic etc.
 
-            One can use short cuts using e.g. that $N$ defines
+            For isotropic subgroups use :meth:`isotropic_subgroups`, which uses that $N$ defines
             an isotropic subgroups if and only if $N^tJN$ is half integral (where $J$ is the Gram matrix
             w.r.t the fundamental generators of this module.
         """
@@ -1410,6 +1470,83 @@ class FiniteQuadraticModule_ambient (AbelianGroup):
                     # d == None means we return every subgroup
                     yield f
         
+
+    def isotropic_subgroups( self, order = None):
+        r"""
+        Return a generator over all isotropic subgroups of self of the given order,
+        or over all isotropic subgroups if order is not set.
+
+        INPUT
+            order -- integer
+
+        OUTPUT
+            generator for a list of FiniteQuadraticModule_subgroup
+
+        EXAMPLES
+            sage: B.<a> = FiniteQuadraticModule( '25^-1'); B
+            Finite quadratic module in 1 generators:
+             gens: a
+             form: 2/25*x^2
+            sage: list(B.isotropic_subgroups())
+            [< 5*a >, < 0 >]
+            sage: A = FiniteQuadraticModule('3^-3.27^2')
+            sage: I = list(A.isotropic_subgroups(9))
+            sage: len(I) == len([U for U in A.subgroups(9) if U.is_isotropic()])
+            True
+
+        NOTES
+            As for :meth:`subgroups`, the subgroups are enumerated as matrices $H$
+            in lower Hermite normal form left dividing the diagonal matrix $E$ of the
+            elementary divisors. Here only the diagonals $d_i | e_i$ with $\prod d_i = |M|/order$
+            are considered, and the rows of $H$ are filled in from the bottom.
+            As soon as the diagonal entry of row $r$ is chosen, the $r$-th column of $H$
+            (i.e. the $r$-th generator of the subgroup) is known and we check that $Q$ vanishes on it
+            and that $B$ vanishes on it and the columns already known,
+            using the integral matrix $2l\cdot J$, where $l$ is the level.
+            The remaining entries of row $r$ are only enumerated if this check succeeds.
+        """
+        E = [Integer(e) for e in self.elementary_divisors()]
+        N = len(E)
+        Mat = MatrixSpace(ZZ, N)
+        D = 2*self.level()
+        A = [[Integer(a) for a in r] for r in D*self.__J]
+        if order is not None:
+            if not Integer(order).divides(self.order()):
+                return
+            det = Integer(self.order()/order)
+        # the products of the elementary divisors e_0,...,e_{r-1}
+        heads = [prod(E[:r]) for r in range(N+1)]
+
+        def Qint( x, y):
+            return sum( x[i]*A[i][j]*y[j] for i in range(N) if x[i] != 0 for j in range(N) if y[j] != 0)
+
+        H = [[0]*N for r in range(N)]
+
+        def rows( r, det):
+            # rows r+1,...,N-1 of H are fixed, det is the product of the diagonal entries d_0,...,d_r
+            if r < 0:
+                yield [list(x) for x in H]
+                return
+            for d in divisors(E[r]):
+                if det is not None and (not d.divides(det) or not (det//d).divides(heads[r])):
+                    continue
+                H[r][r] = d
+                c = [H[i][r] for i in range(N)]
+                if Qint( c, c) % D != 0:
+                    continue
+                if any( (2*Qint( c, [H[i][k] for i in range(N)])) % D != 0 for k in range(r+1, N)):
+                    continue
+                for n in itertools.product( range(d), repeat = r):
+                    H[r][:r] = list(n)
+                    for h in rows( r-1, None if det is None else det//d):
+                        yield h
+            H[r] = [0]*N
+
+        for h in rows( N-1, None if order is None else det):
+            h1 = Mat(h)
+            if FiniteQuadraticModule_subgroup._divides( h1, self.__E):
+                yield FiniteQuadraticModule_subgroup( [FiniteQuadraticModuleElement( self, list(x), can_coords = False) for x in h1.transpose()])
+
     
     ###################################
     ## Auxiliary functions
@@ -2568,6 +2705,190 @@ class FiniteQuadraticModuleElement(AdditiveGroupElement):
     
 
 
+###################################
+## CLASS QUAD_MODULE_ELEMENT_ARRAY
+###################################
+
+
+class FiniteQuadraticModuleElementArray(SageObject):
+    r"""
+    Describes a finite sequence of elements of a quadratic module,
+    stored as an (m x r) int64 array of coordinates w.r.t. the
+    fundamental generators (r being the number of elementary divisors).
+
+    All operations act on the whole array at once.
+    An element $x$ is packed into the index $x_0 + d_0(x_1 + d_1(x_2 + \cdots))$,
+    where $d_i$ are the elementary divisors; equality and hashing use these indices.
+
+    EXAMPLES
+        sage: A = FiniteQuadraticModule([1,3])
+        sage: X = A.elements_array(); X
+        Array of 12 elements of Finite quadratic module in 2 generators:
+         gens: e0, e1
+         form: 1/4*x0^2 + 1/12*x1^2
+        sage: Y = X + X[5]
+        sage: all( Y[i] == X[i] + X[5] for i in range(len(X)))
+        True
+        sage: all( A.Q(x) == Integer(q)/24 for x, q in zip(-X*5, (-X*5).Q()))
+        True
+        sage: list(X.order()) == [x.order() for x in X]
+        True
+    """
+
+    def __init__( self, A, x, can_coords = False):
+        r"""
+        Create the array of elements of the FiniteQuadraticModule_ambient A whose coordinates
+        with respect to the fundamental generators of $A$ (resp. the generators if can_coords = True)
+        are the rows of x. Here x is an array with one column for each fundamental generator
+        (resp. generator) or a list of elements of A (then can_coords must be False).
+
+        EXAMPLES
+            sage: A = FiniteQuadraticModule('3^1.4_1^1')
+            sage: len(A.gens()), A.elementary_divisors()
+            (2, (12,))
+            sage: X = FiniteQuadraticModuleElementArray( A, [[1,0], [0,1], [1,1]], can_coords = True)
+            sage: [x.c_list() for x in X] == [(A.0).c_list(), (A.1).c_list(), (A.0 + A.1).c_list()]
+            True
+        """
+        import numpy as np
+        self.__A = A
+        self.__ed = np.array( [long(e) for e in A.elementary_divisors()], dtype = np.int64)
+        if isinstance( x, (list, tuple)) and len(x) > 0 and isinstance( x[0], FiniteQuadraticModuleElement):
+            if can_coords:
+                raise ValueError, "the coordinates of elements are always w.r.t. the fundamental generators"
+            x = [ y.list() for y in x]
+        if can_coords:
+            C = A._c2f_array( np.array( x, dtype = np.int64).reshape( -1, len( A.gens())))
+        else:
+            C = np.array( x, dtype = np.int64).reshape( -1, len( self.__ed))
+        self.__C = C % self.__ed
+
+    @staticmethod
+    def from_indices( A, indices):
+        r"""
+        Return the array of the elements of A with the given packed indices.
+        """
+        import numpy as np
+        ed = np.array( [long(e) for e in A.elementary_divisors()], dtype = np.int64)
+        radix = np.cumprod( np.concatenate( ([1], ed[:len(ed)-1]))).astype( np.int64)
+        indices = np.asarray( indices, dtype = np.int64)
+        return FiniteQuadraticModuleElementArray( A, (indices[:,None] // radix) % ed)
+
+    def _new( self, C):
+        X = FiniteQuadraticModuleElementArray.__new__( FiniteQuadraticModuleElementArray)
+        X.__A = self.__A
+        X.__ed = self.__ed
+        X.__C = C % self.__ed
+        return X
+
+    def _repr_( self):
+        return "Array of %s elements of %s" % (len(self), self.__A)
+
+    def ambience( self):
+        r"""
+        Return the quadratic module containing the elements of self.
+        """
+        return self.__A
+
+    def coordinates( self):
+        r"""
+        Return the coordinates w.r.t. the fundamental generators as an (m x r) int64 array.
+        """
+        return self.__C
+
+    def indices( self):
+        r"""
+        Return the packed indices of the elements as an int64 array.
+        """
+        import numpy as np
+        ed = self.__ed
+        radix = np.cumprod( np.concatenate( ([1], ed[:len(ed)-1]))).astype( np.int64)
+        return self.__C.dot( radix)
+
+    def __len__( self):
+        return self.__C.shape[0]
+
+    def __getitem__( self, i):
+        r"""
+        Return the i-th element, or an array if i is a slice, an index array or a boolean mask.
+        """
+        import numpy as np
+        if isinstance( i, (int, long, Integer, np.integer)):
+            return FiniteQuadraticModuleElement( self.__A, [Integer(a) for a in self.__C[int(i)]])
+        return self._new( self.__C[i])
+
+    def __iter__( self):
+        for i in xrange( len(self)):
+            yield self[i]
+
+    def _coords( self, y):
+        # the coordinates of an element or an array of elements of the same module
+        if isinstance( y, FiniteQuadraticModuleElementArray) and y.__A is self.__A:
+            return y.__C
+        if isinstance( y, FiniteQuadraticModuleElement) and y.parent() is self.__A:
+            import numpy as np
+            return np.array( [long(a) for a in y.list()], dtype = np.int64)
+        raise TypeError, "cannot combine %s with %s" % (y, self)
+
+    def __add__( self, y):
+        return self._new( self.__C + self._coords( y))
+
+    __radd__ = __add__
+
+    def __sub__( self, y):
+        return self._new( self.__C - self._coords( y))
+
+    def __neg__( self):
+        return self._new( -self.__C)
+
+    def __mul__( self, _n):
+        n = int(_n)
+        if n != _n:
+            raise TypeError, "Argument n (= %s) must be an integer." % _n
+        # reduce n first to avoid overflows
+        return self._new( (n % self.__ed) * self.__C)
+
+    __rmul__ = __mul__
+
+    def Q( self):
+        r"""
+        Return the int64 array of the values $D\cdot Q(x) \bmod D$, where $D = 2\cdot$ level.
+        """
+        D, A = self.__A._integral_gram()
+        Y = self.__C.dot( A) % D
+        return (self.__C * Y).sum( axis = 1) % D
+
+    def B( self, y):
+        r"""
+        Return the int64 array of the values $D\cdot B(x,y) \bmod D$, where $D = 2\cdot$ level,
+        for a fixed element y of the quadratic module.
+        """
+        if not isinstance( y, FiniteQuadraticModuleElement) or y.parent() is not self.__A:
+            raise TypeError, "y (= %s) must be an element of %s" % (y, self.__A)
+        D, A = self.__A._integral_gram()
+        return (2 * self.__C.dot( A.dot( self._coords( y)) % D)) % D
+
+    def order( self):
+        r"""
+        Return the int64 array of the orders of the elements.
+        """
+        import numpy as np
+        o = self.__ed // np.gcd( self.__C, self.__ed)
+        return np.lcm.reduce( o, axis = 1) if o.shape[1] > 0 else np.ones( len(self), dtype = np.int64)
+
+    def __eq__( self, other):
+        import numpy as np
+        if not isinstance( other, FiniteQuadraticModuleElementArray) or other.__A is not self.__A:
+            return False
+        return np.array_equal( self.indices(), other.indices())
+
+    def __ne__( self, other):
+        return not self.__eq__( other)
+
+    def __hash__( self):
+        return hash( (id(self.__A), self.indices().tobytes()))
+
+
 ###################################
 ## CLASS QUAD_MODULE_SUBGROUP
 ###################################
@@ -208,6 +208,7 @@ from setuptools import setup
 
 
 
+package_data = dict()
 packages = [
              'sfqm',
              'sfqm.simple',
@@ -221,6 +222,8 @@ if INSTALL_PSAGE:
           'psage.modform.weilrep_tools'
         ]
     )
+    # the atlas of local weight one-half invariants shipped with the package
+    package_data['psage.modform.weilrep_tools'] = ['data/*.txt.gz']
 
 code = setup(
     name = 'sfqm',
@@ -234,5 +237,6 @@ code = setup(
     platforms = ['any'],
     download_url = 'http://www.github.com/sehlen/sfqm',
     ext_modules = ext_modules,
-    package_dir = package_dir
+    package_dir = package_dir,
+    package_data = package_data
 )
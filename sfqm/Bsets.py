@@ -22,14 +22,13 @@ def is_quotient(M,sym,rank):
             return False
     #if not N.signature() == M.signature():
     #    return False
-    for G in N.subgroups():
-        if G.order() == t and G.is_isotropic():
-            Q = G.quotient()
-            if Q.is_isomorphic(M):
-                print Q
-                return N.jordan_decomposition().genus_symbol()
-            else:
-                del(Q)
+    for G in N.isotropic_subgroups(t):
+        Q = G.quotient()
+        if Q.is_isomorphic(M):
+            print Q
+            return N.jordan_decomposition().genus_symbol()
+        else:
+            del(Q)
     del(N)
     return False
 
@@ -2,5 +2,6 @@ from sage.all import ZZ, Zmod, sys, parallel, is_prime, colors, cached_function,
 from sage.parallel.decorate import *
 from sage.misc.cachefunc import *
 from genus_symbol import GenusSymbol, gamma1_genus_symbol, gamma0_N_genus_symbol, t1_genus_symbol
+from dimension_store import DimensionStore, dimension_store, set_dimension_store, using_dimension_store
 
 __all__ = ['genus_symbol']
@@ -0,0 +1,158 @@
+r"""
+A persistent store for dimensions of spaces of vector valued modular forms.
+
+The dimensions computed by :meth:`GenusSymbol.dimension_cusp_forms` and
+:meth:`GenusSymbol.dimension_modular_forms` are stored in an SQLite database.
+They are keyed by the canonical genus symbol, the kind of the space, the weight
+and the flags ``no_inv``, ``aniso_formula``, ``test_positive`` and ``reduction``.
+
+The database may be used by several processes at the same time
+(for instance by the workers of a ``@parallel`` computation).
+Each process opens its own connection and the database is used in WAL mode,
+so readers do not block writers.
+
+The store is enabled by :func:`set_dimension_store` or by setting
+the environment variable ``SFQM_DIMENSION_STORE`` to the name of the database file.
+The context manager :func:`using_dimension_store` enables a store temporarily.
+
+EXAMPLES::
+
+    sage: from sfqm.fqm.dimension_store import DimensionStore
+    sage: D = DimensionStore(tmp_filename(ext='.sqlite'))
+    sage: flags = (False, False, False, True)
+    sage: D.get('3^-1', 'dimension_cusp_forms', [2, 3], flags)
+    {}
+    sage: D.put('3^-1', 'dimension_cusp_forms', {2: 0, 3: 1}, flags)
+    sage: D.get('3^-1', 'dimension_cusp_forms', [2, 3, 4], flags)
+    {2: 0, 3: 1}
+    sage: from sfqm.fqm.dimension_store import dimension_store, using_dimension_store
+    sage: S = dimension_store()
+    sage: with using_dimension_store(D._filename):
+    ....:     dimension_store()
+    Dimension store in ...
+    sage: dimension_store() is S
+    True
+"""
+
+import os
+import sqlite3
+from contextlib import contextmanager
+from sage.all import Integer, QQ
+
+_schema = """
+CREATE TABLE IF NOT EXISTS dimensions (
+    symbol TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    weight TEXT NOT NULL,
+    no_inv INTEGER NOT NULL,
+    aniso_formula INTEGER NOT NULL,
+    test_positive INTEGER NOT NULL,
+    reduction INTEGER NOT NULL,
+    dimension INTEGER NOT NULL,
+    PRIMARY KEY (symbol, kind, weight, no_inv, aniso_formula, test_positive, reduction)
+)
+"""
+
+
+class DimensionStore(object):
+    r"""
+      A dimension store backed by the SQLite database ``filename``.
+    """
+
+    def __init__(self, filename, timeout=60):
+        self._filename = filename
+        self._timeout = timeout
+        self._connection = None
+        self._pid = None
+
+    def __repr__(self):
+        return "Dimension store in {0}".format(self._filename)
+
+    def _connect(self):
+        # a connection must not be shared with forked processes
+        if self._connection is None or self._pid != os.getpid():
+            c = sqlite3.connect(self._filename, timeout=self._timeout)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute(_schema)
+            c.commit()
+            self._connection = c
+            self._pid = os.getpid()
+        return self._connection
+
+    def get(self, symbol, kind, ks, flags):
+        r"""
+          Returns a dictionary mapping each weight in ks
+          that is contained in the store to the stored dimension.
+
+          INPUT:
+          - symbol: the canonical genus symbol, as a string
+          - kind: 'dimension_cusp_forms' or 'dimension_modular_forms'
+          - ks: a list of weights
+          - flags: the tuple (no_inv, aniso_formula, test_positive, reduction)
+        """
+        weights = dict((str(QQ(k)), k) for k in ks)
+        if len(weights) == 0:
+            return dict()
+        c = self._connect()
+        rows = c.execute(
+            "SELECT weight, dimension FROM dimensions WHERE symbol = ? AND kind = ? "
+            "AND no_inv = ? AND aniso_formula = ? AND test_positive = ? AND reduction = ? "
+            "AND weight IN ({0})".format(','.join('?' * len(weights))),
+            (symbol, kind) + tuple(int(bool(f)) for f in flags) + tuple(weights.keys()))
+        return dict((weights[str(w)], Integer(d)) for w, d in rows)
+
+    def put(self, symbol, kind, dims, flags):
+        r"""
+          Stores the dimensions in the dictionary dims (mapping weights to dimensions).
+          The arguments are as for :meth:`get`.
+        """
+        if len(dims) == 0:
+            return
+        flags = tuple(int(bool(f)) for f in flags)
+        c = self._connect()
+        with c:
+            c.executemany(
+                "INSERT OR REPLACE INTO dimensions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(symbol, kind, str(QQ(k))) + flags + (int(d),) for k, d in dims.iteritems()])
+
+_store = None
+_store_initialized = False
+
+
+def dimension_store():
+    r"""
+      Returns the dimension store that is currently used, or None.
+    """
+    global _store, _store_initialized
+    if not _store_initialized:
+        filename = os.environ.get('SFQM_DIMENSION_STORE')
+        _store = DimensionStore(filename) if filename else None
+        _store_initialized = True
+    return _store
+
+
+def set_dimension_store(filename):
+    r"""
+      Use the database ``filename`` to store dimensions.
+      If filename is None, no persistent store is used.
+    """
+    global _store, _store_initialized
+    _store = DimensionStore(filename) if filename is not None else None
+    _store_initialized = True
+
+
+@contextmanager
+def using_dimension_store(filename):
+    r"""
+      A context manager that uses the database ``filename`` to store dimensions
+      inside the ``with`` block and restores the previous store afterwards.
+      If filename is None, no persistent store is used inside the block.
+    """
+    global _store, _store_initialized
+    previous = dimension_store()
+    set_dimension_store(filename)
+    try:
+        yield _store
+    finally:
+        _store = previous
+        _store_initialized = True
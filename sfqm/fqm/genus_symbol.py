@@ -24,23 +24,135 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
-from sage.all import ZZ, Zmod, sys, parallel, is_prime, colors, cached_function, Integer, Partitions, Set, QQ, RR, is_prime_power, next_prime, prime_range, is_squarefree, uniq, MatrixSpace, kronecker, CC, exp, walltime, RealField, floor, pari, pi, ComplexField, sqrt, text, arrow, is_even, squarefree_part, polygon2d, CyclotomicField, is_odd, is_even, is_prime, cartesian_product, prod, log, gcd, sign, valuation, binomial, inverse_mod, lcm, odd_part
+from sage.all import ZZ, Zmod, sys, parallel, is_prime, colors, cached_function, Integer, Partitions, Set, QQ, RR, is_prime_power, next_prime, prime_range, is_squarefree, uniq, MatrixSpace, kronecker, CC, exp, walltime, RealField, floor, pari, pi, ComplexField, sqrt, text, arrow, is_even, squarefree_part, polygon2d, CyclotomicField, is_odd, is_even, is_prime, cartesian_product, prod, log, gcd, sign, valuation, binomial, inverse_mod, lcm, odd_part, primitive_root
 from psage.modules.finite_quadratic_module import FiniteQuadraticModule
 from psage.modform.weilrep_tools.dimension import VectorValuedModularForms
 from sage.misc.decorators import options
 from sage.misc.flatten import flatten
 from sage.misc.latex import LatexExpr
-from sage.modular.dims import dimension_cusp_forms
+from sage.modular.dims import dimension_cusp_forms, dimension_modular_forms
 from copy import copy, deepcopy
 from sage.parallel.decorate import *
 from sage.misc.cachefunc import *
+from weakref import WeakValueDictionary
+from functools import wraps
+import inspect
 import itertools
+import numpy as np
 from sfqm.tools import BB, h
+from sfqm.fqm.dimension_store import dimension_store
+
+
+def _slot_cached_method(f):
+    r"""
+      Decorator that caches the values of a method of a GenusSymbol.
+
+      Genus symbols have no ``__dict__``, hence ``cached_method`` cannot
+      be used. Instead, the values are stored in the slot ``_cache``.
+      As for ``cached_method``, positional and keyword arguments are normalized,
+      so that ``s.is_simple(2)`` and ``s.is_simple(k=2)`` share the same entry.
+    """
+    argspec = inspect.getargspec(f)
+    names = argspec.args[1:]
+    defaults = argspec.defaults or ()
+    defaults = dict(zip(names[len(names) - len(defaults):], defaults))
+
+    @wraps(f)
+    def cached_f(self, *args, **kwds):
+        key = (f.__name__,) + args + tuple(kwds.get(x, defaults.get(x)) for x in names[len(args):])
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        v = f(self, *args, **kwds)
+        self._cache[key] = v
+        return v
+    return cached_f
+
 
 class GenusSymbol(object):
 
+    # Genus symbols are immutable and interned:
+    # constructing the same (reduced) symbol twice returns the same object.
+    __slots__ = ('_symbol_dict', '_canonical', '_hash', '_order', '_level', '_level_factorization', '_cache', '__weakref__')
+
     _K = CyclotomicField(8)
     _z = _K.gen()
+    _interned = WeakValueDictionary()
+
+    def __new__(cls, s='1^+1', reduce_symbol=True):
+        if isinstance(s, GenusSymbol):
+            return s
+        if isinstance(s, dict):
+            if not GenusSymbol._is_valid_dict(s):
+                raise ValueError
+            d = dict((p, tuple(tuple(c) for c in l)) for p, l in s.iteritems())
+        elif s == '' or s == '1' or s == '1^1' or s == '1^+1':
+            d = dict()
+        else:
+            d = GenusSymbol._from_string(s)
+            if not GenusSymbol._is_valid_dict(d):
+                raise ValueError
+            d = dict((p, tuple(tuple(c) for c in l)) for p, l in d.iteritems())
+        if reduce_symbol:
+            d = dict((p, _reduce_components(p, l)) for p, l in d.iteritems())
+            d = dict((p, l) for p, l in d.iteritems() if len(l) > 0)
+        return cls._from_symbol_dict(d)
+
+    @classmethod
+    def _from_symbol_dict(cls, d):
+        r"""
+          Returns the genus symbol with the dictionary ``d``,
+          which has to map primes to tuples of valid Jordan components (as tuples).
+
+          The dictionary is not copied and must not be modified afterwards.
+          If an equal symbol already exists, it is returned instead.
+        """
+        key = tuple(sorted(d.iteritems()))
+        s = cls._interned.get(key)
+        if s is not None:
+            return s
+        s = object.__new__(cls)
+        setattr = object.__setattr__
+        setattr(s, '_symbol_dict', d)
+        setattr(s, '_cache', dict())
+        order = Integer(1)
+        level = Integer(1)
+        level_factorization = list()
+        for p, l in sorted(d.iteritems()):
+            p = Integer(p)
+            order *= prod(p ** (c[0] * c[1]) for c in l)
+            if len(l) > 0:
+                v = max(c[0] for c in l)
+                if p == 2 and any(c[0] == v and c[3] == 1 for c in l):
+                    v += 1
+                level *= p ** v
+                level_factorization.append((p, Integer(v)))
+        setattr(s, '_order', order)
+        setattr(s, '_level', level)
+        setattr(s, '_level_factorization', tuple(level_factorization))
+        canonical = list()
+        for p in sorted(d.keys()):
+            l = tuple(c for c in d[p] if c[0] != 0 and c[1] != 0)
+            if len(l) == 0:
+                continue
+            if p == 2:
+                l = _canonical_2_adic(l)
+            canonical.append((p, tuple(sorted(tuple(c) for c in l))))
+        canonical = tuple(canonical)
+        setattr(s, '_canonical', canonical)
+        setattr(s, '_hash', hash(canonical))
+        cls._interned[key] = s
+        return s
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Genus symbols are immutable.")
+
+    def __delattr__(self, name):
+        raise AttributeError("Genus symbols are immutable.")
+
+    def __reduce__(self):
+        return (GenusSymbol, (self._symbol_dict,))
 
     def __init__(self, s='1^+1', reduce_symbol=True):
         r"""
@@ -119,40 +231,66 @@ class GenusSymbol(object):
             (zeta8^2, 1/3*sqrt(1/3)),
             (0, 0),
             (1, 1)]
+
+         Genus symbols are immutable and equal symbols are represented by the same object::
+
+           sage: GenusSymbol('3^-1.2_1^+1') is GenusSymbol('2_1^+1.3^-1')
+           True
+           sage: GenusSymbol('3^+1') + GenusSymbol('3^+1') is GenusSymbol('3^+2')
+           True
         """
-        if isinstance(s, dict):
-            self._symbol_dict = s
-            # print "in init: ", s
-            if not self._is_valid():
-                raise ValueError
-        else:
-            if s == '' or s == '1' or s == '1^1' or s == '1^+1':
-                self._symbol_dict = {}
-            else:
-                self._from_string(s)
-        #self.__reset_sigma = False
-        self.__sigma = dict()
-        if reduce_symbol:
-            self._reduce()
-        self._B = dict()
+        # The symbol has already been constructed (and interned) in __new__.
+        pass
 
     def canonical_symbol(self):
-        raise NotImplementedError
+        r"""
+          Returns the canonical genus symbol of the finite quadratic module
+          defined by self.
+
+          Two genus symbols define isomorphic finite quadratic modules
+          if and only if their canonical symbols coincide.
+
+          For odd primes $p$, the reduced $p$-adic symbol is already canonical.
+          The 2-adic symbol is normalized using oddity fusion and sign walking
+          (see Conway and Sloane, Sphere Packings, Lattices and Groups, Chapter 15, Section 7).
+          Note that a finite quadratic module does not see the (even) unimodular
+          part of a lattice. Therefore, the train of a 2-adic symbol that contains
+          an odd constituent $2_t^{\pm n}$ has no sign invariant.
+
+          EXAMPLES::
+
+            sage: GenusSymbol('2_5^-1').canonical_symbol()
+            Genus symbol 2_1^+1
+            sage: GenusSymbol('2_3^-1.4_5^-1').canonical_symbol()
+            Genus symbol 2_1^+1.4_3^-1
+            sage: GenusSymbol('2^-2.4_1^+1').canonical_symbol()
+            Genus symbol 2^+2.4_5^-1
+            sage: GenusSymbol('2^-2.3^+1') == GenusSymbol('2^-2.3^+1').canonical_symbol()
+            True
+        """
+        d = dict()
+        for p, l in self._canonical_key():
+            d[p] = [list(c) for c in l]
+        return GenusSymbol(d)
+
+    def _canonical_key(self):
+        r"""
+          Returns a hashable tuple which is an invariant of the
+          isomorphism class of the finite quadratic module defined by self.
+          It is computed on construction.
+        """
+        return self._canonical
 
     def defines_isomorphic_module(self, other):
+        r"""
+          Returns True if self and other define isomorphic finite quadratic modules.
+          This is checked by comparing the canonical symbols.
+        """
         if isinstance(other, str):
             other = GenusSymbol(other)
         elif not isinstance(other, GenusSymbol):
             raise TypeError
-        if self == other:
-            return True
-        if self.group_structure() != other.group_structure():
-            return False
-        divs = self.level().divisors()
-        for t in divs:
-            if self.char_invariant(t) != other.char_invariant(t):
-                return False
-        return True
+        return self._canonical_key() == other._canonical_key()
 
     def finite_quadratic_module(self):
         r"""
@@ -161,31 +299,65 @@ class GenusSymbol(object):
         return FiniteQuadraticModule(str(self))
 
     def p_rank(self, p):
-        if not is_prime(p):
-            return Integer(0)
+        # the keys of the symbol dictionary are primes
         if not self._symbol_dict.has_key(p):
             return Integer(0)
         return sum([s[1] for s in self._symbol_dict[p]])
 
     def order(self):
-        if self._symbol_dict == {}:
-            return Integer(1)
-        else:
-            return Integer(prod([p ** (s[0] * s[1]) for p, l in self._symbol_dict.iteritems() for s in l]))
+        return self._order
+
+    def _level_primes(self):
+        r"""
+          Returns the list of primes dividing the level (and the order) of self.
+          The factorization of the level is stored on construction,
+          so no integer factorization is needed.
+        """
+        return [p for p, v in self._level_factorization]
+
+    @_slot_cached_method
+    def _level_divisors(self):
+        r"""
+          Returns the sorted list of divisors of the level of self,
+          computed from the stored factorization of the level.
 
-    @cached_method
+          EXAMPLES::
+
+            sage: GenusSymbol('2_1^+1.3^-1')._level_divisors()
+            [1, 2, 3, 4, 6, 12]
+        """
+        divs = [Integer(1)]
+        for p, v in self._level_factorization:
+            divs = [d * p ** k for d in divs for k in range(v + 1)]
+        return sorted(divs)
+
+    def _prime_power(self, q):
+        r"""
+          Returns the pair (p, n) with q = p^n for a prime power q
+          and raises a ValueError if q is not a prime power.
+          The primes dividing the level are tried first,
+          so that q is only factored if it is coprime to the level.
+        """
+        q = Integer(q)
+        for p, v in self._level_factorization:
+            if q % p == 0:
+                n = q.valuation(p)
+                if q != p ** n:
+                    raise ValueError("q (={0}) has to be a prime power".format(q))
+                return p, n
+        return _prime_power_factor(q)
+
+    @_slot_cached_method
     def _ppowers(self, p=None):
         if p == None:
-            return sorted([p**a.valuation(p) for p in self.level().prime_divisors() for a in self.jordan_components(p)])
+            return sorted([p**a.valuation(p) for p in self._level_primes() for a in self.jordan_components(p)])
         else:
             return sorted([p**a.valuation(p) for a in self.jordan_components(p)])
 
-    @cached_method
+    @_slot_cached_method
     def group_structure(self):
         l = []
-        # print "type(level): ", type(self.level())
-        # print self.level().prime_factors()
-        for p in self.level().prime_factors():
+        for p in self._level_primes():
             # print p, type(p)
             for c in self.jordan_components(p):
                 # print c, type(c)
@@ -286,7 +458,7 @@ class GenusSymbol(object):
         """
         n = self.order()
         if not p:
-            _P = n.prime_divisors()
+            _P = self._level_primes()
             if 2 in _P:
                 # WHY????
                 _P.remove(2)
@@ -303,7 +475,7 @@ class GenusSymbol(object):
         return orbit_dict
 
 
-    @cached_method
+    @_slot_cached_method
     def _orbit_list(self, p, short = False, debug = 0):
         r"""
         If this is the Jordan decomposition for $(M,Q)$, return the dictionary of
@@ -627,6 +799,8 @@ class GenusSymbol(object):
         OUTPUT:
             dictionary -- the mapping Q(x) --> the number of elements x with the same value Q(x)
 
+        The dictionary is computed from :meth:`values_array`.
+
         EXAMPLES:
             sage: A = FiniteQuadraticModule('3^-3.27^2')
             sage: J = JordanDecomposition(A)
@@ -670,167 +844,57 @@ class GenusSymbol(object):
                   15/16: 1024}
             True
         """
-        n = self.order()
-
-        values = [1]
-        
-        def combine_lists( list1, list2):
-            N1 = len(list1)
-            N2 = len(list2)
-            newlength = lcm(N1,N2)
-            newlist = [0 for j1 in range(0,newlength)]
-            for j1 in range(0,N1):
-                n1 = list1[j1]
-                if n1 != 0:
-                    for j2 in range(0,N2):
-                        n2 = list2[j2]
-                        if n2 != 0:
-                            newlist[(j1 * Integer(newlength / N1) + j2 * Integer(newlength / N2)) % newlength] += (n1 * n2)
-            return newlist        
-
-        def values_even2adic(gs):
-            l, n, eps, t, o = gs._symbol_dict[2][0]
-            n /= 2
-            factor = 2**((l-1)*n)
-            if n == 1 and eps == 1:
-                return [factor * (l+2)] + [factor * (valuation(j,2)+1) for j in range(1,2**l)]
-            else:
-                quotient = Integer(2**n-eps)/Integer(2**(n-1)-eps)
-                return [factor * (quotient * (2**((n-1)*(l+1))-eps**(l+1)) + eps**(l+1))] + [factor * quotient * (2**((n-1)*(l+1)) - eps**(valuation(j,2)+1) * 2**((n-1)*(l-valuation(j,2)))) for j in range(1,2**l)] 
-            
-        def values_odd2adic(gs):
-            p = 2
-            l, n, eps, tp, t = gs._symbol_dict[2][0]
-            # t = t%8
-            if eps == +1:
-                if t == 0:
-                    tvalues = (1,7)
-                elif t == 1:
-                    tvalues = (1,)
-                elif t == 2:
-                    tvalues = (1,1)
-                elif t == 3:
-                    tvalues = (1,1,1)
-                elif t == 4:
-                    tvalues = (1,1,1,1)
-                elif t == 5:
-                    tvalues = (7,7,7)
-                elif t == 6:
-                    tvalues = (7,7)
-                elif t == 7:
-                    tvalues = (7,)
-                else:
-                    raise TypeError
-            elif eps == -1:
-                if t == 0:
-                    tvalues = (5,1,1,1)
-                elif t == 1:
-                    tvalues = (3,7,7)
-                elif t == 2:
-                    tvalues = (3,7)
-                elif t == 3:
-                    tvalues = (3,)
-                elif t == 4:
-                    tvalues = (3,1)
-                elif t == 5:
-                    tvalues = (5,)
-                elif t == 6:
-                    tvalues = (5,1)
-                elif t == 7:
-                    tvalues = (5,1,1)
-            else:
-                raise TypeError
-
-            level = 2**(l+1)
-            squarerepresentationlist = [0 for j in range(0,level)]
-            if is_even(l+1):
-                squarerepresentationlist[0] = squarerepresentationlist[2**(l-1)] = 2**((l+1)/2)
-            else:
-                squarerepresentationlist[0] = squarerepresentationlist[2**l] = 2**(l/2)
-            for k in range(0,l-1,2):
-                if debug > 0: print "k:", k
-                for a in range(1, 2**(l+1-k),8):
-                    if debug > 0: print "a:", a
-                    squarerepresentationlist[2**k * a] = 2**(k/2 + 2)
-            if debug > 0: print "Test the squarelist:", sum(squarerepresentationlist) == level, squarerepresentationlist, level
-
-            if debug > 0: print "tvalues", tvalues
-            
-            t1inverse = inverse_mod(tvalues[0], level)
-            values = [squarerepresentationlist[(j * t1inverse)%level]/2 for j in range(0,level)]
-
-            if len(tvalues) > 1: #The following works only for tvalues where the last elements coincide
-
-                t2inverse = inverse_mod(tvalues[1], level)
-                newvalues = [squarerepresentationlist[(j * t2inverse)%level]/2 for j in range(0,level)]
-
-                for j in range(1,len(tvalues)):
-                    values = combine_lists(values, newvalues)
-
-            neven = n - len(tvalues)
-            if neven > 0:
-                values = combine_lists(values, values_even2adic(GenusSymbol('' + str(2**l) + '^+' + str(neven))))
-            
-            return values
-
-                
-        _P = n.prime_divisors()
-        if 2 in _P:
+        a = self.values_array()
+        N = len(a)
+        valuesdict = {Integer(int(j))/N : Integer(int(a[j])) for j in np.flatnonzero(a)}
+        if debug > 0: print valuesdict
+        return valuesdict
+
+    @_slot_cached_method
+    def values_array(self):
+        r"""
+        Returns the value distribution of the quadratic form as an integer array.
 
-            _P.remove(2)
-            
-            l = copy(self._ppowers(2))
-            while l != []:
-                q = l.pop()
-                gs = self.jordan_component(q)
-                if gs.is_odd():
-                    values = combine_lists(values, values_odd2adic(gs))
+        OUTPUT:
+            a read-only numpy array a of length $N$, the level of self,
+            such that a[j] is the number of elements x with $Q(x) = j/N$.
+
+        ALGORITHM:
+            For every Jordan component, the distribution of its values is computed
+            from the rank one components by cyclic convolution
+            (for $p = 2$, we use closed formulas, see :func:`_values_even_2_adic`).
+            The components of the same prime are combined by cyclic convolution
+            and the $p$-parts by the Chinese remainder theorem.
+
+        EXAMPLES::
+
+            sage: GenusSymbol('3^-1').values_array()
+            array([1, 2, 0])
+            sage: GenusSymbol('2_1^+1.3^-1').values_array()
+            array([1, 0, 0, 2, 1, 0, 0, 0, 2, 0, 0, 0])
+            sage: s = GenusSymbol('2_3^-3.4^2.8_2^-2.3^-3.27^2')
+            sage: sum(s.values_array()) == s.order()
+            True
+        """
+        dtype = _values_dtype(self.order())
+        a = np.ones(1, dtype=dtype)
+        for p, v in self._level_factorization:
+            N = p ** v
+            ap = np.zeros(N, dtype=dtype)
+            ap[0] = 1
+            for c in self._symbol_dict[p]:
+                if p != 2:
+                    h = _values_odd_p_adic(p, c[0], c[1], c[2])
+                elif c[3] == 1:
+                    h = _values_odd_2_adic(c[0], c[1], c[2], c[4])
                 else:
-                    values = combine_lists(values, values_even2adic(gs))
-                if debug > 0: print values
-
-        _P.sort( reverse = True)
-
-        while [] != _P:
-
-            p = _P.pop()
-            if debug > 0: print "p = ", p
-            shortorbitdict = self.orbit_list(p, short = True)
-            level = max(self._ppowers(p))
-            newvalues = [0 for j in range(0,level)]
-            newvalues[0] = 1
-            
-            for orbit in shortorbitdict.keys():
-
-                if orbit != (1,):
-                    
-                    k = Integer(valuation(orbit[0],p)-1)
-                    # if debug > 0: print orbit
-                    v1 = orbit[1]
-                    if v1 == orbit[k+1]:
-                    
-                        orbitlengthsbykronecker = shortorbitdict[orbit]
-                        for t1 in range(0,p**(k+1)):
-                            newvalues[Integer(v1 * t1 * level / p**(k+1)) % level] += orbitlengthsbykronecker[kronecker(t1,p) + 1]
-
-                    else:
-
-                        newvalues[Integer(v1 * orbit[k+2] * level) % level] += shortorbitdict[orbit]
-
-                    # if debug > 0: print "Position1:", sum(newvalues)
-            # if debug > 0: print "1:", values
-            # if debug > 0: print "2:", newvalues
-            values = combine_lists(values, newvalues)
-            # if debug > 0: print "3:", values
-            # if debug > 0: print "Position2:", values, _P, p
-
-        # if debug > 0: print "Position3:", values
-            
-        valuesdict = {Integer(j)/len(values) : values[j] for j in range(0,len(values)) if values[j] != 0}
-
-        # if debug > 0: print "Position4:", values, valuesdict, "END"
-            
-        return valuesdict #, values
+                    h = _values_even_2_adic(c[0], c[1], c[2])
+                e = np.zeros(N, dtype=dtype)
+                e[::N // len(h)] = h
+                ap = _cyclic_convolution(ap, e)
+            a = _crt_product(a, ap)
+        a.flags.writeable = False
+        return a
 
     def two_torsion_values( self):
         r"""
@@ -846,68 +910,16 @@ class GenusSymbol(object):
             sage: J.two_torsion_values() == {0: 48, 1/4: 16, 1/2: 16, 3/4: 48}
             True
         """
-        n = self.order()
-
-        values = [1]
-        
-        def combine_lists( list1, list2):
-            N1 = len(list1)
-            N2 = len(list2)
-            newlength = lcm(N1,N2)
-            newlist = [0 for j1 in range(0,newlength)]
-            for j1 in range(0,N1):
-                n1 = list1[j1]
-                if n1 != 0:
-                    for j2 in range(0,N2):
-                        n2 = list2[j2]
-                        if n2 != 0:
-                            newlist[(j1 * Integer(newlength / N1) + j2 * Integer(newlength / N2)) % newlength] += (n1 * n2)
-            return newlist        
-
-        def two_torsion_values_even2adic(gs):
-            l, n, eps, t, o = gs._symbol_dict[2][0]
-            n /= 2
-            fourn = 4**n
-            if l == 1:
-                epstwon = eps * 2**n
-                return [(fourn + epstwon)/2, (fourn - epstwon)/2]
-            else:
-                return [fourn]
-                
-        def two_torsion_values_odd2adic(gs):
-            l, n, eps, tp, t = gs._symbol_dict[2][0]
-            if l == 1:
-                # if debug > 0: print "n:", n, "eps:", eps, "t:", t, "n-t:", n-t, (n-t)/2
-                if eps == -1:
-                    t = (t + 4) % 8
-                n2 = ((n - t)/2) % 4
-                n1 = n - n2
-                # if debug > 0: print "n1:", n1, "n2:", n2, "t:", t
-                list1 = [sum([binomial(n1,k) for k in range(j,n1+1,4)]) for j in range(0,4)]
-                # if debug > 0: print list1
-                if n2 == 0:
-                    return list1
-                else:
-                    list2 = [[1,0,0,1],[1,0,1,2],[1,1,3,3]][n2 - 1]
-                    # if debug > 0: print list2
-                    return combine_lists(list1, list2)
-            elif l == 2:
-                twonminusone = 2**(n-1)
-                return [twonminusone, twonminusone]
+        a = np.zeros(4, dtype=_values_dtype(self.order()))
+        a[0] = 1
+        for c in self._symbol_dict.get(2, ()):
+            if c[3] == 1:
+                a = _cyclic_convolution(a, _two_torsion_values_odd_2_adic(c[0], c[1], c[2], c[4]))
             else:
-                return [2**n]
-            
-        for gs in self.jordan_components(2):
-            if gs.order()==1:
-                continue
-            if gs.is_odd():
-                values = combine_lists(values, two_torsion_values_odd2adic(gs))
-            else:
-                values = combine_lists(values, two_torsion_values_even2adic(gs))
-            
-        valuesdict = {Integer(j)/len(values) : values[j] for j in range(0,len(values)) if values[j] != 0}
+                a = _cyclic_convolution(a, _two_torsion_values_even_2_adic(c[0], c[1], c[2]))
+        valuesdict = {Integer(j)/4 : Integer(int(a[j])) for j in range(4) if a[j] != 0}
 
-        return valuesdict #, values
+        return valuesdict
 
     def torsion(self, m):
         fac = self._torsion_factors(m)
@@ -917,9 +929,10 @@ class GenusSymbol(object):
             return prod([p ** r for p, r in fac])
 
     def _torsion_factors(self, m):
-        if not is_prime_power(m):
+        try:
+            p, r = self._prime_power(m)
+        except ValueError:
             raise NotImplementedError
-        p, r = Integer(m).factor()[0]
         J = self.jordan_components(p)
         if J == [GenusSymbol('1^+1')]:
             return None
@@ -931,9 +944,9 @@ class GenusSymbol(object):
 
     def sigma(self, s):
         res = Integer(1)
-        for p in self.level().prime_factors():
+        for p, v in self._level_factorization:
             res = res * (Integer(1) + sum([p ** (r * s + self._torsion_factors(p ** r)[0][1] / Integer(2))
-                                  for r in range(1, self.level().valuation(p) + Integer(1))]))
+                                  for r in range(1, v + Integer(1))]))
         return res
 
     def oddity(self):
@@ -942,7 +955,7 @@ class GenusSymbol(object):
         else:
             return (sum([_[4] for _ in self._symbol_dict[2]]) + 4 * len([_ for _ in self._symbol_dict[2] if is_odd(_[0]) and _[2] == -1])) % 8
 
-    @cached_method
+    @_slot_cached_method
     def dimension_estimate_for_anisotropic(self, k, use_simple_est=False):
         N = self.level()
         A2 = self.torsion(2)
@@ -965,7 +978,8 @@ class GenusSymbol(object):
 
     def gaussum(self, s, p=None, F=CC):
         o = self.order() if p == None else p ** self.order().valuation(p)
-        return F(self.char_invariant(s, p)[0] * self.char_invariant(s, p)[1] * o)
+        ci = self.char_invariant(s, p)
+        return F(ci[0] * ci[1] * o)
 
     def eps(self, p=None):
         a = self.gaussum(1, p)
@@ -980,9 +994,10 @@ class GenusSymbol(object):
         A = self.order()
         q = 1
         N = Integer(self.level())
+        P = self._level_primes()
         if debug > 0:
             print "N={0}".format(N)
-        for p in N.prime_factors():
+        for p in P:
             c = self.jordan_components(p)[0]._symbol_dict[p][0]
             if len(c) == 3:
                 if c[1] == 2:
@@ -991,7 +1006,8 @@ class GenusSymbol(object):
                 q = q * 2
         if debug > 2:
             print A, N, q
-        r1 = lambda d: (-1) ** (len(Integer(gcd(d, q)).prime_factors()))
+        # all divisors d of N and q are products of the primes in P
+        r1 = lambda d: (-1) ** (len([p for p in P if gcd(d, q) % p == 0]))
 
         R2 = self.p_rank(2)
         if debug > 0:
@@ -1007,7 +1023,7 @@ class GenusSymbol(object):
 
         def r3(d):
             R3 = Integer(
-                len([_ for _ in Integer(d / gcd(d, q)).prime_factors() if _ % 4 == 3]))
+                len([p for p in P if p % 4 == 3 and Integer(d / gcd(d, q)) % p == 0]))
             if is_odd(R3):
                 return kronecker(-4, R3)
             else:
@@ -1017,7 +1033,7 @@ class GenusSymbol(object):
             dd = odd_part(d / gcd(d, q))
             a = kronecker(N / d, odd_part(dd))
             sig = lambda p: self.jordan_component(p)._symbol_dict[p][0][2]
-            a *= prod(sig(p) * kronecker(8, p) for p in dd.prime_factors())
+            a *= prod(sig(p) * kronecker(8, p) for p in P if dd % p == 0)
             return a
 
         delta = kronecker(-4, R2)
@@ -1081,10 +1097,10 @@ class GenusSymbol(object):
         eps = lambda d: eps2(d) * eps_odd(d) * r1(d) * r2(d) * r3(d)
 
         if debug > 0:
-            for d in N.divisors():
+            for d in self._level_divisors():
                 if d * gcd(d, q) % 4 in [0, 3]:
                     print "d = {0}, r1(d) = {1}, r2(d) = {2}, r3(d) = {3}, eps_odd(d) = {4}, eps2(d) = {5}, H(-d(q,d)) = {6}".format(d, r1(d), r2(d), r3(d), eps_odd(d), eps2(d), h(d*gcd(d,q), prec))
-        return -sum(q / gcd(d, q) * eps(d) * h(d * gcd(d, q), prec) for d in N.divisors() if d * gcd(d, q) % 4 in [0, 3])
+        return -sum(q / gcd(d, q) * eps(d) * h(d * gcd(d, q), prec) for d in self._level_divisors() if d * gcd(d, q) % 4 in [0, 3])
 
     def beta_est(self, simple_est=False, debug=0):
         prec = max(log(self.order(), 2), 53)
@@ -1094,7 +1110,7 @@ class GenusSymbol(object):
         N = self.level()
         if debug > 0:
             print "N={0}".format(N)
-        for p in N.prime_factors():
+        for p in self._level_primes():
             c = self._symbol_dict[p]
             if len(c) == 1:
                 if len(c[0]) == 3:
@@ -1120,19 +1136,20 @@ class GenusSymbol(object):
             hh = lambda d: log(d) * sqrt(d) / RF.pi()
         else:
             hh = h
-        return sum(q / gcd(d, q) * r2(d) * hh(d * gcd(d, q)) for d in N.divisors() if d * gcd(d, q) % 4 in [0, 3])
+        return sum(q / gcd(d, q) * r2(d) * hh(d * gcd(d, q)) for d in self._level_divisors() if d * gcd(d, q) % 4 in [0, 3])
 
     #@cached_method
     def sigmag(self):
         N = self.level()
         res = 1
-        for p in self.level().prime_factors():
+        for p in self._level_primes():
             resp = 0
             for c in self.jordan_components(p):
-                for r in range(0, c.level().valuation(p) + 1):
-                    g = c.char_invariant(p ** r)
-                    # print g
-                    resp = resp + abs(imag_part(CC(g[0])) / RR(p ** r))
+                S = [p ** r for r in range(0, c.level().valuation(p) + 1)]
+                E, R = c.char_invariants(S)
+                for i in range(len(S)):
+                    if R[i] != 0:
+                        resp = resp + abs(CC(self._z ** int(E[i])).imag() / RR(S[i]))
             res = res * resp
         return res * RR(sqrt(self.order()))
 
@@ -1202,9 +1219,9 @@ class GenusSymbol(object):
                 vcnew[val] += mult
         return vcnew
 
-    @cached_method
+    @_slot_cached_method
     def values_stupid(self):
-        ps = self.level().prime_factors()
+        ps = self._level_primes()
         levels = []
         for p in ps:
             for c in self.jordan_components(p):
@@ -1273,70 +1290,111 @@ class GenusSymbol(object):
         $$\chi_A (s)= |M|^{-1}\sum_{x\in M} \exp(2\pi i s Q(x))).$$
 
         NOTE
-            We apply the formula in [Sko, Second Proof of Theorem 1.4.1].
-            Code taken from FQM package
+            This is a wrapper around :meth:`char_invariants`.
+            The first entry of the result is a power of $\zeta_8$ (or 0)
+            and the second one the absolute value of $\chi_A(s)$.
+
+        EXAMPLES::
 
-        EXAMPLES NONE
+            sage: s = GenusSymbol('3^-1')
+            sage: s.char_invariant(1)
+            (zeta8^2, sqrt(1/3))
         """
         # manual caching
         s = s % self.level()
-        if self.__sigma.has_key((s, p)):
-            return self.__sigma[(s, p)]
+        key = ('char_invariant', s, p)
+        if self._cache.has_key(key):
+            return self._cache[key]
+        E, R = self.char_invariants([s], p)
+        if debug > 0: print "E={0}, R={1}".format(E, R)
+        if R[0] == 0:
+            v = (0, 0)
+        else:
+            v = (self._z ** int(E[0]), QQ(R[0]).sqrt())
+        self._cache[key] = v
+        return v
 
-        #t = cputime()
-        if s == 0:
-            return 1, 1
-        if not p is None and not is_prime(p):
-            raise TypeError
-        if p and 0 != self.order() % p:
-            return 1, 1
-        _p = p
+    def char_invariants(self, S, p=None):
+        r"""
+        Returns the characteristic function of self (or of its p-part if $p$ is a prime)
+        at all $s$ in S (see :meth:`char_invariant`).
 
-        K = self._K
-        z = self._z
+        INPUT:
+            - S: a list or array of integers
+            - p: a prime or None
 
-        jd = self.jordan_decomposition(flat = True)
+        OUTPUT:
+            a pair (E, R) of arrays of the same length as S,
+            such that the value at S[i] is $\zeta_8^{E[i]} \sqrt{R[i]}$.
+            E is an integer array with entries in 0..7
+            and R an array of rational numbers
+            (if R[i] is 0, the value is 0 and we set E[i] = 0).
 
-        ci = ci1 = 1
-        for p, c in jd:
-            # c: basis, ( prime p,  valuation of p-power n, dimension r,
-            # determinant d over p [, oddity o])
-            n = c.valuation(p)
-            r = c.p_rank(p)
-            d = c._eps(p, n)
-            if debug > 0: print "p={0}, n={1}, r={2}, d={3}".format(p,n,r,d)
-            if _p and p != _p:
+        NOTE
+            We apply the formula in [Sko, Second Proof of Theorem 1.4.1]
+            for all s at once, Jordan component by Jordan component.
+            Powers of $\zeta_8$ are represented by their exponents.
+
+        EXAMPLES::
+
+            sage: s = GenusSymbol('3^-1')
+            sage: s.char_invariants([0, 1, 2, 3])
+            (array([0, 2, 6, 0]), array([1, 1/3, 1/3, 1], dtype=object))
+            sage: s = GenusSymbol('2_1^+1.4^-2')
+            sage: s.char_invariants([1, 2, 4])
+            (array([1, 0, 0]), array([1/32, 0, 1], dtype=object))
+        """
+        if not p is None and not (p in self._level_primes() or is_prime(p)):
+            raise TypeError
+        N = self.level()
+        S = np.array([Integer(s) % N for s in S], dtype=_values_dtype(N))
+        E = np.zeros(len(S), dtype=np.int64)
+        zero = np.zeros(len(S), dtype=bool)
+        D = dict()
+        for q, v in self._level_factorization:
+            if not p is None and q != p:
                 continue
-            o = None if p != 2 else (0 if c.is_even() else c._symbol_dict[2][0][4])
-            if debug > 0: print "o=",o
-            odd = c.is_odd()
-            k = valuation(s, p)
-            s1 = Integer(s / p ** k)
-            h = max(n - k, 0)
-            if debug > 0: print "h={0}".format(h)
-            q = p ** h
-            if p != 2:
-                lci = z ** ((r * (1 - q)) % 8) * d ** (h % 2) if h > 0 else 1
-                lci1 = q ** (-r) if h > 0 else 1
-            elif k == n and odd:
-                # print "t!"
-                return 0, 0
-            else:
-                f = z ** o if odd else 1
-                lci = f * d ** (h % 2) if h > 0 else 1
-                lci1 = q ** (-r) if h > 0 else 1
-                if debug > 0: print "f={0}, d={1}, lci={2}".format(f, d, lci)
-            if 2 == p:
-                lci = lci ** s1
-            if debug > 0: print "lci=",lci
-            if debug > 0: print "lci1=", lci1
-            ci *= lci * kronecker(s1, 1 / lci1)
-            ci1 *= lci1
-        v = (ci, QQ(ci1).sqrt())
-        self.__sigma[(s, p)] = v
-        return v
-
-    @cached_method
+            q, v = int(q), int(v)
+            # k = valuation of s at q, but at most v + 1 (also for s = 0)
+            # and s1 = s / q^k
+            k = np.where(S == 0, v + 1, 0)
+            s1 = S.copy()
+            for i in range(v + 1):
+                m = (S != 0) & (s1 % q == 0)
+                if not m.any():
+                    break
+                k += m
+                s1 = np.where(m, s1 // q, s1)
+            s1 = (s1 % (q if q != 2 else 8)).astype(np.int64)
+            kron = np.array([kronecker(a, q) for a in range(q if q != 2 else 8)])[s1]
+            D[q] = np.zeros(len(S), dtype=np.int64)
+            for c in self._symbol_dict[q]:
+                # scale n, rank r, sign d (and oddity o)
+                n, r, d = int(c[0]), int(c[1]), int(c[2])
+                odd = q == 2 and c[3] == 1
+                h = np.maximum(n - k, 0)
+                pos = h > 0
+                if odd:
+                    zero |= (k == n)
+                e = np.where(pos & (h % 2 == 1), 0 if d == 1 else 4, 0)
+                if q != 2:
+                    # zeta8^(r(1-q^h))
+                    qh = np.array([Integer(q).powermod(i, 8) for i in range(n + 1)])
+                    e += np.where(pos, r * (1 - qh[h]), 0)
+                else:
+                    if odd:
+                        e += np.where(pos, int(c[4]), 0)
+                    e *= s1
+                # the Kronecker symbol (s1, q^(hr))
+                e += np.where((kron == -1) & ((h * r) % 2 == 1), 4, 0)
+                E = (E + e) % 8
+                D[q] += h * r
+        E[zero] = 0
+        R = np.array([QQ(0) if zero[i] else QQ(1) / prod(Integer(q) ** int(D[q][i]) for q in D.keys())
+                      for i in range(len(S))], dtype=object)
+        return E, R
+
+    @_slot_cached_method
     def two_torsion_values_stupid(self):
         J = self.jordan_components(2)
         vals = dict()
@@ -1358,9 +1416,9 @@ class GenusSymbol(object):
                             svals = {
                                 0: oh, QQ(1) / QQ(2): 2 ** s.p_rank(2) - oh}
                 else:
-                    # TODO: improve this part as well
-                    M = s.finite_quadratic_module()
-                    svals = M.kernel_subgroup(2).as_ambient()[0].values()
+                    c = s._symbol_dict[2][0]
+                    a = _two_torsion_values_odd_2_adic(c[0], c[1], c[2], c[4])
+                    svals = {Integer(j)/4 : Integer(int(a[j])) for j in range(4) if a[j] != 0}
 
             if vals == {}:
                 vals = svals
@@ -1382,26 +1440,16 @@ class GenusSymbol(object):
         '''
         if not self._symbol_dict.has_key(p):
             return 0
-        if not isinstance(self._symbol_dict[p], list):
+        if not isinstance(self._symbol_dict[p], (list, tuple)):
             return 0
         if len(self._symbol_dict[p]) == 0:
             return 0
         return max(_[0] for _ in self._symbol_dict[p])
 
-    @cached_method
     def level(self):
-        l = Integer(prod([p ** self.valuation(p)
-                          for p in self._symbol_dict.keys()]))
-        # print l
-        if self.p_rank(2) > 0:
-            ll = [_[0] for _ in self._symbol_dict[2] if _[3] == 1]
-            if ll == []:
-                return l
-            if max(ll) == self.valuation(2):
-                l = l * 2
-        return l
+        return self._level
 
-    @cached_method
+    @_slot_cached_method
     def signature(self):
         sig = 0
         if len(self._symbol_dict) == 0:
@@ -1424,7 +1472,7 @@ class GenusSymbol(object):
                         (4 * r if eps == -1 else 0) % 8
         return Integer(sig % 8)
 
-    @cached_method
+    @_slot_cached_method
     def is_simple(self, k, no_inv=False, aniso_formula=False, reduction=True, bound=0):
         d = self.dimension_cusp_forms(
             k, no_inv, aniso_formula, test_positive=True if bound == 0 else False, reduction=reduction)
@@ -1446,7 +1494,7 @@ class GenusSymbol(object):
         # print D
         if even and (r - s) % 8 != self.signature():
             return False
-        for p in self.level().prime_factors():
+        for p in self._level_primes():
             if self.p_rank(p) > r + s:
                 return False
             elif self.p_rank(p) == r + s:
@@ -1478,7 +1526,7 @@ class GenusSymbol(object):
             print nonstr
             return None
         
-        for p in self.level().prime_factors():
+        for p in self._level_primes():
             satisfied = True
             if not (r+s >= 2 + self.p_rank(p)):
                 satisfied = False
@@ -1517,12 +1565,13 @@ class GenusSymbol(object):
         return True
 
     def _eps(self, q, n=None, total=False):
-        if not Integer(q).is_prime_power():
-            raise ValueError("q={0} has to be a prime power".format(q)) 
-        p = q.prime_factors()[0]
+        try:
+            p, m = self._prime_power(q)
+        except ValueError:
+            raise ValueError("q={0} has to be a prime power".format(q))
         if n is None and not total:
             # if n is given, we assume that p is a prime and n is the valuation
-            n = q.valuation(p)
+            n = m
         if not self._symbol_dict.has_key(p):
             return 1
         l = self._symbol_dict[p]
@@ -1533,7 +1582,6 @@ class GenusSymbol(object):
         else:
             return Integer(prod(s[2] for s in l if s[0] == n))
 
-    @cached_method
     def dimension_modular_forms(self, k, no_inv=False, aniso_formula=False, test_positive=False, reduction=False):
         r"""
           Computes the dimension of the space of modular forms of weight $k$
@@ -1557,18 +1605,8 @@ class GenusSymbol(object):
           SEE ALSO:
           - For more details, see the implementation in PSAGE.
         """
-        s = str(self)
-        if not s == '1^+1':
-            #M = FiniteQuadraticModule(s)
-            V = VectorValuedModularForms(
-                s, True, aniso_formula=aniso_formula, use_reduction=reduction)
-            d = V.dimension(
-                k, no_inv=no_inv, test_positive=test_positive)
-        else:
-            d = dimension_modular_forms(1, k)
-        return d
+        return self.dimension_modular_forms_table([k], no_inv, aniso_formula, test_positive, reduction)[k]
 
-    @cached_method
     def dimension_cusp_forms(self, k, no_inv=False, aniso_formula=False, test_positive=False, reduction=False):
         r"""
           Computes the dimension of the space of cusp forms of weight $k$
@@ -1592,16 +1630,135 @@ class GenusSymbol(object):
           SEE ALSO:
           - For more details, see the implementation in PSAGE.
         """
-        s = str(self)
-        if not s == '1^+1':
-            #M = FiniteQuadraticModule(s)
-            V = VectorValuedModularForms(
-                s, True, aniso_formula=aniso_formula, use_reduction=reduction)
-            d = V.dimension_cusp_forms(
-                k, no_inv=no_inv, test_positive=test_positive)
+        return self.dimension_cusp_forms_table([k], no_inv, aniso_formula, test_positive, reduction)[k]
+
+    def dimension_modular_forms_table(self, ks, no_inv=False, aniso_formula=False, test_positive=False, reduction=False):
+        r"""
+          Computes the dimensions of the spaces of modular forms of weight $k$
+          for all $k$ in ks.
+
+          INPUT:
+          - ks: a list of half-integers, the weights, >= 2
+          - the other arguments are as for :meth:`dimension_modular_forms`
+
+          OUTPUT:
+          - a dictionary mapping each weight $k$ in ks to the dimension
+            of the space of modular forms of weight $k$
+
+          The weight independent quantities (values, Gauss sums, ...) are
+          computed only once. The results are cached and shared
+          with :meth:`dimension_modular_forms` and, if enabled,
+          with the persistent store (see :mod:`sfqm.fqm.dimension_store`).
+        """
+        return self._dimension_table('dimension_modular_forms', ks, no_inv, aniso_formula, test_positive, reduction)
+
+    def dimension_cusp_forms_table(self, ks, no_inv=False, aniso_formula=False, test_positive=False, reduction=False):
+        r"""
+          Computes the dimensions of the spaces of cusp forms of weight $k$
+          for all $k$ in ks.
+
+          INPUT:
+          - ks: a list of half-integers, the weights, >= 3/2
+          - the other arguments are as for :meth:`dimension_cusp_forms`
+
+          OUTPUT:
+          - a dictionary mapping each weight $k$ in ks to the dimension
+            of the space of cusp forms of weight $k$
+
+          The weight independent quantities (values, Gauss sums, ...) are
+          computed only once. The results are cached and shared
+          with :meth:`dimension_cusp_forms` and, if enabled,
+          with the persistent store (see :mod:`sfqm.fqm.dimension_store`).
+        """
+        return self._dimension_table('dimension_cusp_forms', ks, no_inv, aniso_formula, test_positive, reduction)
+
+    def _dimension_table(self, name, ks, no_inv, aniso_formula, test_positive, reduction):
+        flags = (no_inv, aniso_formula, test_positive, reduction)
+        dims = dict()
+        missing = list()
+        for k in ks:
+            d = self._cache.get((name, k) + flags)
+            if d is None:
+                missing.append(k)
+            else:
+                dims[k] = d
+        if len(missing) == 0:
+            return dims
+        # the persistent store is consulted before any formula is evaluated
+        store = dimension_store()
+        if store is not None:
+            symbol = str(self.canonical_symbol())
+            dims.update(store.get(symbol, name, missing, flags))
+        computed = dict()
+        V = None
+        for k in missing:
+            if dims.has_key(k):
+                continue
+            if str(self) == '1^+1':
+                if name == 'dimension_cusp_forms':
+                    d = dimension_cusp_forms(1, k)
+                else:
+                    d = dimension_modular_forms(1, k)
+            else:
+                if V is None:
+                    V = VectorValuedModularForms(
+                        str(self), True, aniso_formula=aniso_formula, use_reduction=reduction)
+                if name == 'dimension_cusp_forms':
+                    d = V.dimension_cusp_forms(
+                        k, no_inv=no_inv, test_positive=test_positive)
+                else:
+                    d = V.dimension(k)
+            dims[k] = computed[k] = d
+        if store is not None:
+            store.put(symbol, name, computed, flags)
+        for k in missing:
+            self._cache[(name, k) + flags] = dims[k]
+        return dims
+
+    def simplicity_profile(self, bound=0, no_inv=False, aniso_formula=False, reduction=True):
+        r"""
+          Returns the sorted list of all weights $k \geq 2$ such that
+          the dimension of the space of cusp forms of weight $k$ is at most bound.
+
+          Weights with $2k + s$ odd, where $s$ is the signature, and weights for which
+          the Weil representation on even resp. odd functions is zero are omitted,
+          since the space of cusp forms is zero for trivial reasons.
+
+          ALGORITHM:
+          For $k \geq 5/2$, the dimension formula is of the form
+          $d k/12 + c(k)$ with $c(k)$ only depending on $k$ modulo $12$
+          and $d$ the dimension of the representation on even resp. odd functions.
+          We therefore compute the dimensions for one period and
+          extend them linearly.
+
+          EXAMPLES::
+
+            sage: s = GenusSymbol('3^-1')
+            sage: p = s.simplicity_profile()
+            sage: p == [k for k in range(2, 50) if s.dimension_cusp_forms(k) == 0]
+            True
+        """
+        s = self.signature()
+        m = self.order()
+        n2 = self.torsion(2)
+        if s % 2 == 0:
+            small = [Integer(2)]
+            k1 = Integer(3)
         else:
-            d = dimension_cusp_forms(1, k)
-        return d
+            small = []
+            k1 = Integer(5) / 2
+        period = [k1 + j for j in range(12)]
+        dims = self.dimension_cusp_forms_table(small + period, no_inv, aniso_formula, False, reduction)
+        weights = [k for k in small if dims[k] <= bound]
+        for k in period:
+            if (2 * k + s) % 4 == 0:
+                d = (m + n2) / 2
+            else:
+                d = (m - n2) / 2
+            if d == 0 or dims[k] > bound:
+                continue
+            weights.extend(k + 12 * j for j in range(floor((bound - dims[k]) / d) + 1))
+        return sorted(weights)
 
     def is_even(self):
         r'''
@@ -1624,12 +1781,11 @@ class GenusSymbol(object):
         '''
         if not self._symbol_dict.has_key(p):
             return [GenusSymbol()]
-        self._reduce()
-        return [GenusSymbol({p: [x]}) for x in self._symbol_dict[p]]
+        return [GenusSymbol._from_symbol_dict({p: (x,)}) for x in _reduce_components(p, self._symbol_dict[p])]
 
     def jordan_decomposition(self, flat = False):
         l = {}
-        for p in self.level().prime_factors():
+        for p in self._level_primes():
             l[p] = [c for c in self.jordan_components(p)]
         if not flat:
             return l
@@ -1640,10 +1796,7 @@ class GenusSymbol(object):
             return l1
 
     def jordan_component(self, q):
-        if not is_prime_power(q):
-            raise ValueError
-        else:
-            p, n = list(Integer(q).factor())[0]
+        p, n = self._prime_power(q)
 
         if not self._symbol_dict.has_key(p):
             return GenusSymbol('1^+1')
@@ -1655,27 +1808,25 @@ class GenusSymbol(object):
             if len(r) == 0:
                 return GenusSymbol('1^+1')
             else:
-                return GenusSymbol({p: r})
+                return GenusSymbol._from_symbol_dict({p: _reduce_components(p, r)})
 
     def rank_of_jordan_component(self, q):
-        if not is_prime_power(q):
-            raise ValueError("q (={0}) has to be a prime power".format(q))
+        p, n = self._prime_power(q)
         c = self.jordan_component(q)
         if c.order() == 1:
             return 0
-        return c.p_rank(q.prime_factors()[0])
+        return c.p_rank(p)
 
     def sign_of_jordan_component(self,q):
-        if not is_prime_power(q):
-            raise ValueError("q (={0}) has to be a prime power".format(q))
+        p, n = self._prime_power(q)
         c = self.jordan_component(q)
         if c.order() == 1:
             return 1
-        return c._symbol_dict[q.prime_factors()[0]][0][2]
+        return c._symbol_dict[p][0][2]
 
     def max_rank(self):
         r = 0
-        for p in self.level().prime_factors():
+        for p in self._level_primes():
             r = max(r, self.p_rank(p))
         return r
 
@@ -1701,13 +1852,12 @@ class GenusSymbol(object):
         '''
         CS = C(self, m)
         if unique:
+            # genus symbols are hashed by their canonical symbol
+            seen = set()
             CU = []
             for s in CS:
-                cont = False
-                for t in CU:
-                    if t.defines_isomorphic_module(s):
-                        cont = True
-                if not cont:
+                if not s in seen:
+                    seen.add(s)
                     CU.append(s)
             CS = CU
         return CS
@@ -1739,10 +1889,9 @@ class GenusSymbol(object):
             for s in CS:
                 N = s.finite_quadratic_module()
                 q = False
-                for G in N.subgroups():
-                    if G.is_isotropic() and G.order() == m:
-                        if (N / G).is_isomorphic(M):
-                            q = True
+                for G in N.isotropic_subgroups(m):
+                    if (N / G).is_isomorphic(M):
+                        q = True
                 if not q:
                     print "Ooops, this one seems to be wrong: ", s
                 return False
@@ -1766,9 +1915,10 @@ class GenusSymbol(object):
 
         return True
 
-    def _from_string(self, s, debug = 0):
+    @staticmethod
+    def _from_string(s, debug = 0):
         r'''
-           Initializes a GenusSymbol from a string.
+           Returns the dictionary of Jordan components of the symbol given by the string s.
            Most parts are copied from finite_quadratic_module.py
            in psage. This should be made work nicely together instead.
         '''
@@ -1817,30 +1967,36 @@ class GenusSymbol(object):
                     d[p].append([r, n, eps, 1, t % 8])
             else:
                 d[p].append([r, n, eps])
-        self._symbol_dict = d
-        if not self._is_valid():
-            raise ValueError
+        return d
 
     def _is_valid(self):
         r"""
           Determines if the _symbol_dict dictionary actually defines
           a finite quadratic module.
         """
-        for p, l in self._symbol_dict.iteritems():
+        return GenusSymbol._is_valid_dict(self._symbol_dict)
+
+    @staticmethod
+    def _is_valid_dict(d):
+        r"""
+          Determines if the dictionary d of Jordan components
+          defines a finite quadratic module.
+        """
+        for p, l in d.iteritems():
             if not is_prime(p):
                 return False
             if p != 2:
-                if not isinstance(l, list):
+                if not isinstance(l, (list, tuple)):
                     return False
                 for s in l:
-                    if not isinstance(s, list) or len(s) != 3:
+                    if not isinstance(s, (list, tuple)) or len(s) != 3:
                         return False
                     r, n, eps = s
                     if not eps in [1, -1]:
                         return False
-        if not self._symbol_dict.has_key(2):
+        if not d.has_key(2):
             return True
-        for r, n, eps, tp, t in self._symbol_dict[2]:
+        for r, n, eps, tp, t in d[2]:
             # print r,n,eps,tp,t
             if tp == None:
                 tp = 0
@@ -1855,23 +2011,8 @@ class GenusSymbol(object):
             if tp == 0 and t != 0:
                 return False
             if tp != 0:
-                if 1 == n:
-                    if not eps * n == kronecker(t, 2):
-                        return False
-                if n > 1:
-                    c = None
-                    CP = eval(
-                        "cartesian_product([" + "[1,3,5,7]," * (n - 1) + "])")
-                    # TODO: find better algorithm
-                    for x in CP:
-                        s = sum(x) % 8
-                        if kronecker(prod(x) * (t - s), 2) == eps:
-                            c = list(x)
-                            #c.append(t - s)
-                            break
-                    # print "c=", c
-                    if c is None:
-                        return False
+                if not _is_valid_odd_2_adic(n, eps, t):
+                    return False
         return True
 
     def _to_string(self):
@@ -1897,49 +2038,6 @@ class GenusSymbol(object):
                     symstr = symstr + '^' + sgn + str(s[1])
         return symstr
 
-    def _reduce(self):
-        sym = self._symbol_dict
-        for p, sl in sym.iteritems():
-            for s in sl:
-                if s[1] == 0:
-                    sl.remove(s)
-                if s[0] == 0:
-                    sl.remove(s)
-            if p != 2:
-                sl.sort()
-                for s in sl:
-                    # print s
-                    ssl = copy(sl)
-                    for j in range(sl.index(s) + 1, len(ssl)):
-                        t = ssl[j]
-                        if s[0] == t[0]:
-                            s[1] = s[1] + t[1]
-                            s[2] = s[2] * t[2]
-                            sl.remove(t)
-            else:
-                sl.sort()
-                for s in sl:
-                    # print s
-                    ssl = copy(sl)
-                    for j in range(sl.index(s) + 1, len(ssl)):
-                        t = ssl[j]
-                        if s[0] == t[0]:
-                            # print s, t
-                            if s[3] == None:
-                                s[3] = 0
-                            if t[3] == None:
-                                t[3] = 0
-                            s[1] = s[1] + t[1]
-                            s[2] = s[2] * t[2]
-                            if s[3] != t[3]:
-                                s[3] = 1
-                                s[4] = t[4] if t[3] == 1 else s[4]
-                            else:
-                                s[4] = (s[4] + t[4]) % 8
-                            # print s
-                            sl.remove(t)
-                # print sym
-
     def __repr__(self):
         return "Genus symbol " + self._to_string()
 
@@ -1954,18 +2052,15 @@ class GenusSymbol(object):
 
     def __add__(self, other):
         if other == 0:
-            return deepcopy(self)
-        d = deepcopy(self._symbol_dict)
-        e = other._symbol_dict
-        for p, l in e.iteritems():
+            return self
+        # only the p-parts that change are rebuilt, all others are shared
+        d = dict(self._symbol_dict)
+        for p, l in other._symbol_dict.iteritems():
             if not d.has_key(p):
-                d[p] = deepcopy(e[p])
+                d[p] = l
             else:
-                d[p] = deepcopy(d[p] + e[p])
-        # print "in add: ", d_new
-        s = GenusSymbol(d)
-        s._reduce()
-        return s
+                d[p] = _reduce_components(p, d[p] + l)
+        return GenusSymbol._from_symbol_dict(d)
 
     def __sub__(self, other):
         r"""
@@ -1980,78 +2075,79 @@ class GenusSymbol(object):
           Otherwise, returns an error.
         """
         debug = 0
-        # print "In sub"
         err = ValueError("Result does not define a genus symbol")
-        # print "in sub"
-        # print "self = ", self, " other = ", other
-        s = GenusSymbol(deepcopy(self._symbol_dict))
-        # print "s = ", s
-        s._reduce()
-        d = s._symbol_dict
+        d = dict(self._symbol_dict)
         e = other._symbol_dict
-        # print d, e
         for p, l in e.iteritems():
             if not d.has_key(p):
                 raise err
-            else:
-                for c in e[p]:
-                    # print c
-                    try:
-                        j = s.jordan_component(p ** c[0])._symbol_dict[p]
-                        # print j
-                    except:
-                        raise err
-                    if not len(j) == 1:
-                        raise ValueError("Strange error...")
-                    else:
-                        j = j[0]
-                    if not j[1] - c[1] >= 0:
-                        raise err
-                    else:
-                        if j[1] == c[1] and not j[2] == c[2]:
-                            # same multiplicity, different eps
-                            if debug > 0:
-                                print 'same multiplicity, different eps'
-                            if not (p == 2 and j[0] == 1 and j[4] == (c[4] + 4) % 8 and j[3] == c[3]):
+            # only the p-parts that change are copied
+            sp = [list(c) for c in _reduce_components(p, d[p])]
+            for c in l:
+                j = [x for x in sp if x[0] == c[0]]
+                if len(j) == 0:
+                    raise err
+                if not len(j) == 1:
+                    raise ValueError("Strange error...")
+                else:
+                    j = j[0]
+                if not j[1] - c[1] >= 0:
+                    raise err
+                else:
+                    if j[1] == c[1] and not j[2] == c[2]:
+                        # same multiplicity, different eps
+                        if debug > 0:
+                            print 'same multiplicity, different eps'
+                        if not (p == 2 and j[0] == 1 and j[4] == (c[4] + 4) % 8 and j[3] == c[3]):
+                            raise err
+                    if p == 2:
+                        if j[1] == c[1]:
+                            # same multiplicity
+                            if not j[3] == c[3]:
+                                # different types
                                 raise err
-                        if p == 2:
-                            if j[1] == c[1]:
-                                # same multiplicity
-                                if not j[3] == c[3]:
-                                    # different types
-                                    raise err
-                                if not j[4] == c[4]:
-                                    # different oddity
+                            if not j[4] == c[4]:
+                                # different oddity
+                                if debug > 0:
+                                    print 'same multiplicity, different oddity'
+                                if not (j[0] == 1 and j[4] == (c[4] + 4) % 8 and j[2] != c[2] and j[3] == c[3]):
+                                    # q=2, oddity differs by 4 and sign has
+                                    # changed is ok.
                                     if debug > 0:
-                                        print 'same multiplicity, different oddity'
-                                    if not (j[0] == 1 and j[4] == (c[4] + 4) % 8 and j[2] != c[2] and j[3] == c[3]):
-                                        # q=2, oddity differs by 4 and sign has
-                                        # changed is ok.
-                                        if debug > 0:
-                                            print j[0], (j[4] == (c[4] + 4) % 8), (j[2] != c[2], j[2], c[2]), (j[3] == c[3])
-                                        raise err
-                            # print j[4], c[4], j,c
-                            j[4] = (j[4] - c[4]) % 8
-                            # print j[4]
-                        j[2] = j[2] * c[2]
-                        j[1] = j[1] - c[1]
-        # print s
-        s._reduce()
-        if not s._is_valid():
-            raise err
-        return s
+                                        print j[0], (j[4] == (c[4] + 4) % 8), (j[2] != c[2], j[2], c[2]), (j[3] == c[3])
+                                    raise err
+                        j[4] = (j[4] - c[4]) % 8
+                    j[2] = j[2] * c[2]
+                    j[1] = j[1] - c[1]
+            sp = _reduce_components(p, sp)
+            if not GenusSymbol._is_valid_dict({p: sp}):
+                raise err
+            if len(sp) > 0:
+                d[p] = sp
+            else:
+                del d[p]
+        return GenusSymbol._from_symbol_dict(d)
 
     def __eq__(self, o):
         r"""
-          Check for equality by using the string representation.
+          Check for equality by comparing the canonical symbols.
 
           NOTE:
-          This does not check for isomorphy.
+          Two genus symbols are equal if and only if
+          they define isomorphic finite quadratic modules.
+          Use ``str`` to compare the actual symbols.
         """
-        if str(self) == str(o):
-            return True
-        else:
+        if isinstance(o, str):
+            try:
+                o = GenusSymbol(o)
+            except (ValueError, TypeError):
+                return False
+        if not isinstance(o, GenusSymbol):
             return False
+        return self._canonical_key() == o._canonical_key()
+
+    def __ne__(self, o):
+        return not self.__eq__(o)
 
     def __le__(self, o):
         r"""
@@ -2103,14 +2199,11 @@ class GenusSymbol(object):
 
     def __hash__(self):
         r"""
-          We use the string representation for hasing.
+          We use the canonical symbol for hashing,
+          so that isomorphic modules have the same hash.
+          The hash is computed on construction.
         """
-        # if not hasattr(self,'_hash') or self._hash == None:
-        self._reduce
-        #l = map(lambda x: (x[0],tuple(map(lambda y: tuple(y),x[1]))),list(self._symbol_dict.iteritems()))
-        #self._hash = hash(tuple(l))
-        # return hash(tuple(l))
-        return hash(str(self))
+        return self._hash
 
     def latex(self):
         r"""
@@ -2130,6 +2223,385 @@ class GenusSymbol(object):
         return LatexExpr(o)
 
 
+def _values_dtype(order):
+    r"""
+      Returns the dtype used for value distributions of modules of the given order.
+      Machine integers are used unless they might overflow.
+    """
+    return np.int64 if order < 2 ** 62 else object
+
+
+def _cyclic_convolution(a, b):
+    r"""
+      Returns the cyclic convolution of the integer arrays a and b of the same length,
+      i.e. the value distribution of an orthogonal sum if a and b are value distributions.
+    """
+    c = np.zeros(len(a), dtype=np.result_type(a, b))
+    for i in np.flatnonzero(a):
+        c += a[i] * np.roll(b, i)
+    return c
+
+
+def _cyclic_power(a, n):
+    r"""
+      Returns the n-fold cyclic convolution of the integer array a with itself.
+    """
+    c = np.zeros(len(a), dtype=a.dtype)
+    c[0] = 1
+    while n > 0:
+        if n % 2 == 1:
+            c = _cyclic_convolution(c, a)
+        n = n // 2
+        if n > 0:
+            a = _cyclic_convolution(a, a)
+    return c
+
+
+def _crt_product(a, b):
+    r"""
+      Returns the value distribution of an orthogonal sum of two modules
+      of coprime levels $N_1$ = len(a) and $N_2$ = len(b)
+      with value distributions a and b, indexed by numerators mod $N_1 N_2$.
+    """
+    N1, N2 = len(a), len(b)
+    c = np.zeros(N1 * N2, dtype=np.result_type(a, b))
+    c[(np.arange(N1)[:, None] * N2 + np.arange(N2)[None, :] * N1) % (N1 * N2)] = np.outer(a, b)
+    return c
+
+
+def _square_values(c, N, dtype=np.int64):
+    r"""
+      Returns the value distribution of the rank one module $x \mapsto c x^2 / N$
+      on $\mathbb{Z} / q \mathbb{Z}$, where $q = N$ for odd $N$ and $q = N/2$ otherwise.
+    """
+    q = N if N % 2 == 1 else N // 2
+    x = np.arange(q, dtype=_values_dtype(N ** 2))
+    return np.bincount(((c % N) * x * x % N).astype(np.int64), minlength=N).astype(dtype)
+
+
+@cached_function
+def _values_odd_p_adic(p, r, n, eps):
+    r"""
+      Returns the value distribution of the Jordan component $q^{\epsilon n}$, $q = p^r$,
+      for an odd prime p as a read-only integer array of length q.
+
+      The component is the orthogonal sum of rank one modules $x \mapsto x^2/q$
+      and (if $\epsilon (2/p)^n = -1$) one module $x \mapsto u x^2 / q$
+      with a non-square $u$ (as in psage).
+    """
+    q = p ** r
+    dtype = _values_dtype(q ** n)
+    if eps * kronecker(2, p) ** n == 1:
+        h = _cyclic_power(_square_values(1, q, dtype), n)
+    else:
+        u = -1 if p % 4 == 3 else primitive_root(p)
+        h = _cyclic_convolution(_cyclic_power(_square_values(1, q, dtype), n - 1), _square_values(u, q, dtype))
+    h.flags.writeable = False
+    return h
+
+
+@cached_function
+def _values_even_2_adic(l, n, eps):
+    r"""
+      Returns the value distribution of the even 2-adic Jordan component
+      $q^{\epsilon n}$, $q = 2^l$, as a read-only integer array of length q.
+    """
+    n = n // 2
+    factor = 2 ** ((l - 1) * n)
+    if n == 1 and eps == 1:
+        h = [factor * (l + 2)] + [factor * (valuation(j, 2) + 1) for j in range(1, 2 ** l)]
+    else:
+        quotient = Integer(2 ** n - eps) / Integer(2 ** (n - 1) - eps)
+        h = [factor * (quotient * (2 ** ((n - 1) * (l + 1)) - eps ** (l + 1)) + eps ** (l + 1))] \
+            + [factor * quotient * (2 ** ((n - 1) * (l + 1)) - eps ** (valuation(j, 2) + 1) * 2 ** ((n - 1) * (l - valuation(j, 2))))
+               for j in range(1, 2 ** l)]
+    h = np.array([int(x) for x in h], dtype=_values_dtype(2 ** (2 * l * n)))
+    h.flags.writeable = False
+    return h
+
+
+# Odd 2-adic components of rank n, sign eps and oddity t are the orthogonal sum
+# of the rank one modules x -> c x^2/(2q) for c in _odd_2_adic_diagonal[(eps, t)]
+# and an even component q^{+m}, m = n - len(_odd_2_adic_diagonal[(eps, t)]).
+_odd_2_adic_diagonal = {(1, 0): (1, 7), (1, 1): (1,), (1, 2): (1, 1), (1, 3): (1, 1, 1),
+                        (1, 4): (1, 1, 1, 1), (1, 5): (7, 7, 7), (1, 6): (7, 7), (1, 7): (7,),
+                        (-1, 0): (5, 1, 1, 1), (-1, 1): (3, 7, 7), (-1, 2): (3, 7), (-1, 3): (3,),
+                        (-1, 4): (3, 1), (-1, 5): (5,), (-1, 6): (5, 1), (-1, 7): (5, 1, 1)}
+
+
+@cached_function
+def _values_odd_2_adic(l, n, eps, t):
+    r"""
+      Returns the value distribution of the odd 2-adic Jordan component
+      $q_t^{\epsilon n}$, $q = 2^l$, as a read-only integer array of length 2q.
+    """
+    N = 2 ** (l + 1)
+    cs = _odd_2_adic_diagonal[(eps, t % 8)]
+    dtype = _values_dtype(2 ** (l * n))
+    h = np.zeros(N, dtype=dtype)
+    h[0] = 1
+    for c in cs:
+        h = _cyclic_convolution(h, _square_values(c, N, dtype))
+    if n > len(cs):
+        e = np.zeros(N, dtype=h.dtype)
+        e[::2] = _values_even_2_adic(l, n - len(cs), 1)
+        h = _cyclic_convolution(h, e)
+    h.flags.writeable = False
+    return h
+
+
+@cached_function
+def _two_torsion_values_even_2_adic(l, n, eps):
+    r"""
+      Returns the value distribution on the 2-torsion of the even 2-adic Jordan component
+      $q^{\epsilon n}$, $q = 2^l$, as a read-only integer array a of length 4
+      (a[j] is the number of 2-torsion elements x with $Q(x) = j/4$).
+    """
+    n = n // 2
+    a = np.zeros(4, dtype=_values_dtype(4 ** n))
+    if l == 1:
+        a[0] = (4 ** n + eps * 2 ** n) // 2
+        a[2] = (4 ** n - eps * 2 ** n) // 2
+    else:
+        a[0] = 4 ** n
+    a.flags.writeable = False
+    return a
+
+
+@cached_function
+def _two_torsion_values_odd_2_adic(l, n, eps, t):
+    r"""
+      Returns the value distribution on the 2-torsion of the odd 2-adic Jordan component
+      $q_t^{\epsilon n}$, $q = 2^l$, as a read-only integer array a of length 4
+      (a[j] is the number of 2-torsion elements x with $Q(x) = j/4$).
+
+      For $q = 2$, the component is the orthogonal sum of $n_1$ modules $x \mapsto u x^2/4$
+      with $u = 1 \bmod 4$ and $n_2$ modules with $u = 3 \bmod 4$.
+      For $q = 4$, $Q$ takes the values $0$ and $1/2$ equally often on the 2-torsion
+      and for $q \geq 8$, it vanishes on the 2-torsion.
+
+      EXAMPLES::
+
+        sage: from sfqm.fqm.genus_symbol import _two_torsion_values_odd_2_adic
+        sage: _two_torsion_values_odd_2_adic(1, 3, -1, 3)
+        array([3, 1, 1, 3])
+        sage: _two_torsion_values_odd_2_adic(2, 3, 1, 1)
+        array([4, 0, 4, 0])
+    """
+    a = np.zeros(4, dtype=_values_dtype(2 ** n))
+    if l == 1:
+        if eps == -1:
+            t = (t + 4) % 8
+        n2 = ((n - t) // 2) % 4
+        n1 = n - n2
+        for j in range(4):
+            a[j] = sum([binomial(n1, k) for k in range(j, n1 + 1, 4)])
+        if n2 > 0:
+            a = _cyclic_convolution(a, np.array([[1, 0, 0, 1], [1, 0, 1, 2], [1, 1, 3, 3]][n2 - 1], dtype=a.dtype))
+    elif l == 2:
+        a[0] = a[2] = 2 ** (n - 1)
+    else:
+        a[0] = 2 ** n
+    a.flags.writeable = False
+    return a
+
+
+@cached_function
+def _prime_power_factor(q):
+    r"""
+      Returns the pair (p, n) with q = p^n for a prime power q
+      and raises a ValueError if q is not a prime power.
+    """
+    q = Integer(q)
+    if not q.is_prime_power():
+        raise ValueError("q (={0}) has to be a prime power".format(q))
+    return q.factor()[0]
+
+
+def _reduce_components(p, l):
+    r"""
+      Returns the reduced form of the list ``l`` of p-adic Jordan components,
+      that is, a tuple of components sorted by scale
+      in which the components of the same scale are merged
+      and trivial components are removed.
+    """
+    merged = dict()
+    for c in l:
+        if c[0] == 0 or c[1] == 0:
+            continue
+        c = list(c)
+        if p == 2 and c[3] == None:
+            c[3] = 0
+        s = merged.get(c[0])
+        if s is None:
+            merged[c[0]] = c
+            continue
+        s[1] = s[1] + c[1]
+        s[2] = s[2] * c[2]
+        if p == 2:
+            if s[3] != c[3]:
+                s[3] = 1
+                s[4] = c[4] if c[3] == 1 else s[4]
+            else:
+                s[4] = (s[4] + c[4]) % 8
+    return tuple(tuple(merged[r]) for r in sorted(merged.keys()))
+
+
+def _is_valid_odd_2_adic(n, eps, t):
+    r"""
+      Returns True if there is an odd 2-adic Jordan component
+      of rank n, sign eps and oddity t.
+
+      Such a component is (up to scaling) given by a diagonal form
+      with odd entries $u_1, \ldots, u_n$. The oddity is $\sum u_i \pmod{8}$
+      and the sign is the Kronecker symbol $(u_1 \cdots u_n / 2)$. Hence
+       - for n = 1, the sign is determined by the oddity,
+       - for n = 2, the oddity 4 cannot occur with sign + and the oddity 0 not with sign -,
+       - for n >= 3, every oddity t with t = n mod 2 occurs with both signs.
+
+      EXAMPLES::
+
+        sage: from sfqm.fqm.genus_symbol import _is_valid_odd_2_adic
+        sage: [t for t in range(8) if _is_valid_odd_2_adic(1, -1, t)]
+        [3, 5]
+        sage: [t for t in range(8) if _is_valid_odd_2_adic(2, 1, t)]
+        [0, 2, 6]
+        sage: [t for t in range(8) if _is_valid_odd_2_adic(2, -1, t)]
+        [2, 4, 6]
+        sage: [t for t in range(8) if _is_valid_odd_2_adic(3, -1, t)]
+        [1, 3, 5, 7]
+
+      TESTS:
+
+      Compare with a brute force search over all diagonal forms::
+
+        sage: bf = lambda n, eps, t: any(kronecker(prod(x) * (t - sum(x)), 2) == eps for x in cartesian_product([[1,3,5,7]] * (n - 1)))
+        sage: all(_is_valid_odd_2_adic(n, eps, t) == bf(n, eps, t) for n in range(2, 9) for eps in [1, -1] for t in range(8))
+        True
+    """
+    if not eps in [1, -1]:
+        return False
+    t = t % 8
+    if t % 2 != n % 2:
+        return False
+    if 1 == n:
+        return eps == kronecker(t, 2)
+    if 2 == n:
+        return t != (4 if eps == 1 else 0)
+    return True
+
+
+@cached_function
+def _odd_2_adic_oddities(n, eps):
+    r"""
+      Returns the list of all possible oddities of an odd 2-adic
+      Jordan component of rank n and sign eps.
+    """
+    return [t for t in range(8) if t % 2 == n % 2 and _is_valid_odd_2_adic(n, eps, t)]
+
+
+@cached_function
+def _canonical_2_adic(l):
+    r"""
+      Returns the canonical form of the 2-adic symbol given by the tuple ``l``
+      of Jordan components (r, n, eps, type, oddity) as a tuple of tuples.
+
+      ALGORITHM:
+
+        We compute all sign and oddity configurations
+        that can be reached by oddity fusion and sign walking.
+        A compartment is a maximal run of odd components with consecutive scales
+        and only the total oddity of a compartment is an invariant.
+        A train is a maximal interval of scales such that
+        each pair of adjacent scales contains an odd component.
+        The signs of two components in the same train can be changed simultaneously,
+        each step between adjacent scales changing the oddity of the compartment
+        of the odd component by 4.
+        Since the unimodular part does not contribute to a finite quadratic module,
+        we may assume that the scale 1 is an even component with arbitrary sign.
+
+        Among all reachable configurations that are realized by
+        valid components, we return the smallest one,
+        preferring positive signs and then small oddities.
+    """
+    l = sorted([[c[0], c[1], c[2], 0 if c[3] is None else c[3], c[4]] for c in l])
+    index = dict((c[0], i) for i, c in enumerate(l))
+    is_odd_scale = lambda r: index.has_key(r) and l[index[r]][3] == 1
+    # compartments
+    compartment = dict()
+    k = -1
+    for c in l:
+        if c[3] == 1:
+            if not is_odd_scale(c[0] - 1):
+                k += 1
+            compartment[c[0]] = k
+    oddities = [0] * (k + 1)
+    for c in l:
+        if c[3] == 1:
+            oddities[compartment[c[0]]] = (oddities[compartment[c[0]]] + c[4]) % 8
+    # the sign walks between a component and
+    # the previous one in the same train (or the unimodular part)
+    walks = list()
+    for j, c in enumerate(l):
+        u = c[0]
+        while u > 0 and (is_odd_scale(u - 1) or is_odd_scale(u)):
+            u -= 1
+            if u == 0 or index.has_key(u):
+                steps = [compartment[v if is_odd_scale(v) else v + 1] for v in range(u, c[0])]
+                walks.append((index.get(u), j, steps))
+                break
+    start = (tuple(c[2] for c in l), tuple(oddities))
+    reached = set([start])
+    todo = [start]
+    while todo:
+        signs, odds = todo.pop()
+        for i, j, steps in walks:
+            signs_new = list(signs)
+            odds_new = list(odds)
+            signs_new[j] = -signs_new[j]
+            if i is not None:
+                signs_new[i] = -signs_new[i]
+            for k in steps:
+                odds_new[k] = (odds_new[k] + 4) % 8
+            s = (tuple(signs_new), tuple(odds_new))
+            if not s in reached:
+                reached.add(s)
+                todo.append(s)
+    compartments = dict()
+    for i, c in enumerate(l):
+        if c[3] == 1:
+            compartments.setdefault(compartment[c[0]], []).append(i)
+
+    def fuse(signs, comp, o):
+        # distribute the oddity o on the compartment comp
+        i = comp[0]
+        ts = _odd_2_adic_oddities(l[i][1], signs[i])
+        if len(comp) == 1:
+            return [o] if o in ts else None
+        for t in ts:
+            r = fuse(signs, comp[1:], (o - t) % 8)
+            if r is not None:
+                return [t] + r
+        return None
+
+    best = None
+    for signs, odds in reached:
+        ts = [0] * len(l)
+        for k, comp in compartments.iteritems():
+            r = fuse(signs, comp, odds[k])
+            if r is None:
+                ts = None
+                break
+            for i, t in zip(comp, r):
+                ts[i] = t
+        if ts is None:
+            continue
+        key = [(-signs[i], ts[i]) for i in range(len(l))]
+        if best is None or key < best[0]:
+            best = (key, tuple((c[0], c[1], signs[i], c[3], ts[i]) for i, c in enumerate(l)))
+    return best[1]
+
+
 @cached_function
 def C(genus_symbol, m, use_isomorphisms=True):
     r"""
@@ -33,6 +33,7 @@ import logging
 import datetime
 
 from sfqm.fqm.genus_symbol import GenusSymbol, anisotropic_symbols, prime_anisotropic_symbols
+from sfqm.fqm.dimension_store import using_dimension_store
 
 NCPUS0 = 4
 NCPUS1 = 10
@@ -126,7 +127,7 @@ class SimpleModulesGraph(DiGraph):
     """
 
     def __init__(self, signature=0, weight=2, level_limit=34, rank_limit=4, primes=None, simple_color=None, nonsimple_color=None,
-                 reduction=True, bound=0):
+                 reduction=True, bound=0, dimension_store=None):
         """
             Initialize a SimpleModulesGraph containing finite quadratic modules of signature ``signature``.
             They are checked for being ``weight``-simple if their minimal number of generators
@@ -138,6 +139,11 @@ class SimpleModulesGraph(DiGraph):
             - ``level_limit``: only check for anisotropic modules with level smaller than ``level_limit``
             - ``rank_limit``: an upper bound for the minimal number of generators
             - ``bound``: upper bound for the dimension (for considered being simple), default=0
+            - ``dimension_store``: file name of an SQLite database in which computed dimensions are stored
+                                   and shared between runs and processes (see ``sfqm.fqm.dimension_store``),
+                                   default: None (use the store that is currently set, if any).
+                                   The store is only used during the computations of this graph,
+                                   the store that is currently set is not changed.
 
             OUTPUT:
             A SimpleModulesGraph object. No computations are done after initialization.
@@ -152,6 +158,7 @@ class SimpleModulesGraph(DiGraph):
         self._weight = QQ(weight)
         self._reduction = reduction
         self._bound = bound
+        self._dimension_store = dimension_store
         #########################################################
         # Initialize the primes that need to be checked
         # According to Theorem 4.21 in [BEF],
@@ -178,6 +185,14 @@ class SimpleModulesGraph(DiGraph):
 
     def compute_from_startpoints(self, points, p = None, cut_nonsimple_aniso = True, fast = 1, **kwds):
         self._reduction = kwds.get('reduction', self._reduction)
+        if self._dimension_store is not None:
+            # the parallel processes are forked inside the block
+            # and inherit the store
+            with using_dimension_store(self._dimension_store):
+                return self._compute_from_startpoints(points, p, cut_nonsimple_aniso, fast)
+        return self._compute_from_startpoints(points, p, cut_nonsimple_aniso, fast)
+
+    def _compute_from_startpoints(self, points, p = None, cut_nonsimple_aniso = True, fast = 1):
         if NCPUS0 == 1:
             for a in points:
                 self._compute_simple_modules_graph_from_startpoint(a, p, cut_nonsimple_aniso, fast)
@@ -227,7 +242,8 @@ class SimpleModulesGraph(DiGraph):
     @parallel(ncpus=NCPUS0)
     def _compute_simple_modules_graph_from_startpoint_parallel(self, s, p=None, cut_nonsimple_aniso=True, fast=1):
         G = SimpleModulesGraph(
-            self._signature, self._weight, self._level_limit, self._rank_limit, self._primes, reduction=self._reduction, bound=self._bound)
+            self._signature, self._weight, self._level_limit, self._rank_limit, self._primes, reduction=self._reduction, bound=self._bound,
+            dimension_store=self._dimension_store)
         G._compute_simple_modules_graph_from_startpoint(
             s, p, cut_nonsimple_aniso, fast)
         return G
@@ -301,6 +317,7 @@ class SimpleModulesGraph(DiGraph):
         # if len(primes) == 0:
         #    return
         heights = self._heights
+        height_index = dict()
         h = 0
         if not heights.has_key(h):
             heights[h] = [s]
@@ -355,20 +372,17 @@ class SimpleModulesGraph(DiGraph):
                         # is > than the given rank_limit.
                         continue
                     s2 = FQM_vertex(s2)
-                    skip = False
-                    for v in self._heights[h]:
-                        # we skip symbols that correspond to isomorphic modules
-                        if v.genus_symbol().defines_isomorphic_module(s2.genus_symbol()):
-                            skip = True
-                            logger.debug(
-                                "skipping {0} b/c isomorphic to {1}".format(s2.genus_symbol(), v.genus_symbol()))
-                            s2 = v
-                            break
-                    if skip:
+                    # we skip symbols that correspond to isomorphic modules
+                    # vertices are hashed by the canonical symbol
+                    if not height_index.has_key(h):
+                        height_index[h] = dict((v, v) for v in heights[h])
+                    if height_index[h].has_key(s2):
+                        logger.debug(
+                            "skipping {0} b/c isomorphic to {1}".format(s2.genus_symbol(), height_index[h][s2].genus_symbol()))
                         continue
-                    if not skip:
-                        self.add_vertex(s2)
-                        heights[h].append(s2)
+                    self.add_vertex(s2)
+                    heights[h].append(s2)
+                    height_index[h][s2] = s2
                     self.update_edges(s2, h, fast=fast)
                     # before using the actual dimension formula
                     # we check if there is already a non-k-simple neighbor
@@ -756,14 +770,13 @@ def is_quotient(M, sym, rank):
             return False
     # if not N.signature() == M.signature():
     #    return False
-    for G in N.subgroups():
-        if G.order() == t and G.is_isotropic():
-            Q = G.quotient()
-            if Q.is_isomorphic(M):
-                print Q
-                return N
-            else:
-                del Q
+    for G in N.isotropic_subgroups(t):
+        Q = G.quotient()
+        if Q.is_isomorphic(M):
+            print Q
+            return N
+        else:
+            del Q
     del N
     return False
 